@@ -0,0 +1,52 @@
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import geoindex
+from utils import get_distance
+
+
+MOSCOW = (55.7522, 37.6156)
+DELIVERY_TIERS = [(0.5, 0), (5, 100), (20, 300)]
+
+
+def get_random_entries(count):
+    return [
+        {
+            'id': str(i),
+            'Address': f'Pizzeria {i}',
+            'coordinates': (MOSCOW[0] + random.uniform(-0.5, 0.5), MOSCOW[1] + random.uniform(-0.5, 0.5)),
+        } for i in range(count)
+    ]
+
+
+def find_nearest_with_loop(entries, coordinates):
+    for entry in entries:
+        entry['distance'] = get_distance(coordinates, entry['coordinates'])
+    return min(entries, key=lambda entry: entry['distance'])
+
+
+def measure(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    print(f'{"pizzerias":>10} {"loop, ms":>12} {"index, ms":>12} {"build, ms":>12} {"zone, ms":>12} {"zones build, s":>15}')
+
+    for count in (10, 100, 1000, 10000):
+        entries = get_random_entries(count)
+        customer = (MOSCOW[0] + 0.1, MOSCOW[1] - 0.1)
+        index = geoindex.build_index(entries)
+
+        loop_ms = measure(lambda: find_nearest_with_loop(entries, customer), repeat=3)
+        index_ms = measure(lambda: geoindex.find_nearest(index, customer), repeat=50)
+        build_ms = measure(lambda: geoindex.build_index(entries), repeat=5)
+        zones_s = measure(lambda: geoindex.build_zones(index, DELIVERY_TIERS), repeat=1) / 1000
+        zones = geoindex.build_zones(index, DELIVERY_TIERS)
+        customers = [(MOSCOW[0] + random.uniform(-0.3, 0.3), MOSCOW[1] + random.uniform(-0.3, 0.3)) for _ in range(1000)]
+        zone_ms = measure(lambda: [geoindex.find_zone(zones, point) for point in customers], repeat=5) / len(customers)
+        print(f'{count:>10} {loop_ms:>12.3f} {index_ms:>12.3f} {build_ms:>12.3f} {zone_ms:>12.3f} {zones_s:>15.2f}')
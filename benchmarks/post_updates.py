@@ -0,0 +1,28 @@
+import argparse
+import json
+import time
+
+import requests
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Post recorded Telegram updates to a local webhook')
+    parser.add_argument('updates', help='JSON lines file, one Telegram update per line')
+    parser.add_argument('--url', default='http://localhost:8443/', help='Webhook URL')
+    parser.add_argument('--secret', help='Value for the X-Telegram-Bot-Api-Secret-Token header')
+    parser.add_argument('--delay', type=float, default=0, help='Seconds between updates')
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    headers = {'X-Telegram-Bot-Api-Secret-Token': args.secret} if args.secret else {}
+
+    with requests.Session() as session, open(args.updates) as file:
+        for line in file:
+            if not line.strip():
+                continue
+
+            response = session.post(args.url, data=line.encode(), headers=headers)
+            print(response.status_code, json.loads(line).get('update_id'))
+            time.sleep(args.delay)
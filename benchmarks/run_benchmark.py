@@ -0,0 +1,153 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stub_servers
+
+
+BOT_TOKEN = '123456:benchmark-token-benchmark-token-00'
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Replay scripted conversations against local stubs')
+    parser.add_argument('--chats', type=int, default=1000, help='Simulated chats')
+    parser.add_argument('--concurrency', type=int, default=32, help='Chats handled at the same time')
+    parser.add_argument('--latency', type=float, default=0.02, help='Mean upstream latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of upstream requests failing with 503')
+    parser.add_argument('--products', type=int, default=30)
+    parser.add_argument('--pizzerias', type=int, default=50)
+    parser.add_argument('--pacing', action='store_true', help='Keep the production outbound rate limits')
+    parser.add_argument('--fake-redis', action='store_true', help='Use fakeredis instead of REDIS_HOST/REDIS_PORT')
+    return parser
+
+
+def get_database(fake_redis):
+    if fake_redis:
+        import fakeredis
+        return fakeredis.FakeRedis(decode_responses=True)
+
+    import redis
+    return redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=os.getenv('REDIS_PORT', 6379),
+        password=os.getenv('REDIS_PASSWORD'),
+        decode_responses=True
+    )
+
+
+def create_update(bot, chat_id, text=None, data=None, photo=False):
+    import telegram
+
+    chat = {'id': chat_id, 'type': 'private', 'first_name': 'Bench'}
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}
+    message = {'message_id': random.randint(1, 2 ** 31), 'date': int(time.time()), 'chat': chat}
+
+    if data is None:
+        message.update({'from': user, 'text': text})
+        return telegram.Update.de_json({'update_id': random.randint(1, 2 ** 31), 'message': message}, bot)
+
+    if photo:
+        message.update({'photo': [{'file_id': 'photo', 'width': 800, 'height': 600}], 'caption': ''})
+    else:
+        message['text'] = 'Выбирайте, пожалуйста:'
+    callback_query = {'id': str(random.randint(1, 2 ** 31)), 'chat_instance': '1', 'from': user, 'data': data, 'message': message}
+    return telegram.Update.de_json({'update_id': random.randint(1, 2 ** 31), 'callback_query': callback_query}, bot)
+
+
+def run_conversation(bot_main, bot, state, chat_id, latencies):
+    """menu -> product -> add to cart -> back -> cart -> pay -> address -> delivery"""
+    product = random.choice(state.products)
+
+    def step(label, **kwargs):
+        update = create_update(bot, chat_id, **kwargs)
+        started_at = time.perf_counter()
+        bot_main.handle_users_reply(bot, update)
+        latencies[label].append(time.perf_counter() - started_at)
+
+    step('START', text='/start')
+    step('HANDLE_MENU', data=product['id'])
+    step('HANDLE_DESCRIPTION', data=f'buy/{product["id"]}', photo=True)
+    step('HANDLE_DESCRIPTION', data='back', photo=True)
+    step('HANDLE_MENU', data='cart')
+    step('HANDLE_CART', data='pay')
+    step('HANDLE_WAITING_LOCATION', text=f'Москва, ул. Тверская, {random.randint(1, 200)}')
+
+    customer_id = bot_main.db.hget(f'session:{chat_id}', 'customer_id')
+    step('HANDLE_DELIVERY', data=f'delivery/{customer_id}/100')
+
+
+def get_percentiles(values):
+    if len(values) < 2:
+        return values * 3 or [0, 0, 0]
+    quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return quantiles[49], quantiles[94], quantiles[98]
+
+
+def print_report(latencies, elapsed, errors):
+    updates = sum(len(values) for values in latencies.values())
+    print(f'\n{updates} updates in {elapsed:.2f}s: {updates / elapsed:.1f} updates/s\n')
+    print(f'{"state":<26} {"count":>7} {"p50, ms":>9} {"p95, ms":>9} {"p99, ms":>9}')
+    for label, values in latencies.items():
+        p50, p95, p99 = get_percentiles(values)
+        print(f'{label:<26} {len(values):>7} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {p99 * 1000:>9.1f}')
+
+    if errors:
+        print('\nHandler errors: ' + ', '.join(f'{name}: {count:.0f}' for name, count in errors.items()))
+
+
+def get_errors(metrics):
+    errors = {}
+    for metric in metrics.errors.collect():
+        for sample in metric.samples:
+            if sample.name.endswith('_total'):
+                errors[f'{sample.labels["component"]}/{sample.labels["exception"]}'] = sample.value
+    return errors
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+
+    state = stub_servers.StubState(args.products, args.pizzerias)
+    urls = stub_servers.start_stubs(state, args.latency, args.latency, args.latency, args.error_rate)
+    os.environ.update(urls)
+    if not args.pacing:
+        os.environ.update(TELEGRAM_RATE='1e9', TELEGRAM_CHAT_RATE='1e9', MOLTIN_RATE='1e9')
+
+    import customers
+    import dispatch
+    import elasticpath
+    import main as bot_main
+    import metrics
+    from telegram.utils.request import Request
+
+    bot = bot_main.RateLimitedBot(
+        BOT_TOKEN, base_url=urls['TELEGRAM_API_URL'], request=Request(con_pool_size=args.concurrency + 4))
+    bot_main.db = get_database(args.fake_redis)
+    bot_main.elasticpath_token = partial(elasticpath.get_oauth_access_token, bot_main.db, 'client-id', 'client-secret')
+    bot_main.YANDEX_GEOCODER_KEY = 'benchmark'
+    dispatch.start_dispatchers(bot_main.db, 2, bot_main.ORDER_STEPS, bot)
+    customers.start_flusher(bot_main.db, bot_main.elasticpath_token)
+
+    latencies = defaultdict(list)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        chats = range(10 ** 9, 10 ** 9 + args.chats)
+        list(executor.map(lambda chat_id: run_conversation(bot_main, bot, state, chat_id, latencies), chats))
+
+    print_report(latencies, time.perf_counter() - started_at, get_errors(metrics))
+
+    drain_deadline = time.monotonic() + 30
+    while time.monotonic() < drain_deadline:
+        orders = dispatch.get_stats()
+        if orders.get('orders:dispatched', 0) + orders.get('orders:dead', 0) >= orders.get('orders:queued', 0):
+            break
+        time.sleep(0.1)
+    print('\nOrders: ' + ', '.join(f'{stat.split(":")[1]}: {value}' for stat, value in sorted(dispatch.get_stats().items())))
@@ -0,0 +1,248 @@
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+MOSCOW = (55.7522, 37.6156)
+
+
+class StubState:
+    """In-memory stand-in for the Moltin store: products, files, flows and carts."""
+
+    def __init__(self, products=30, pizzerias=50, seed=0):
+        random.seed(seed)
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.products = []
+        self.files = {}
+        for number in range(products):
+            file_id = str(uuid.uuid4())
+            self.files[file_id] = {'id': file_id, 'file_name': f'{number}.png', 'link': {'href': f'https://cdn.test/{number}.png'}}
+            self.products.append({
+                'id': str(uuid.uuid4()),
+                'type': 'product',
+                'sku': str(number),
+                'name': f'Pizza {number}',
+                'description': 'Tomato, mozzarella, basil',
+                'price': [{'amount': 300 + number, 'currency': 'RUB', 'includes_tax': True}],
+                'relationships': {'main_image': {'data': {'type': 'main_image', 'id': file_id}}},
+            })
+        self.entries = {'Pizzeria': {}, 'Customer': {}}
+        for number in range(pizzerias):
+            entry_id = str(uuid.uuid4())
+            self.entries['Pizzeria'][entry_id] = {
+                'id': entry_id,
+                'Address': f'Pizzeria street, {number}',
+                'Alias': f'pizzeria-{number}',
+                'Latitude': MOSCOW[0] + random.uniform(-0.2, 0.2),
+                'Longitude': MOSCOW[1] + random.uniform(-0.2, 0.2),
+                'DeliverTelegramID': 1000000 + number,
+            }
+        self.carts = {}
+
+    def get_cart_items(self, cart_id):
+        items = []
+        for product_id, quantity in self.carts.get(cart_id, {}).items():
+            product = next(product for product in self.products if product['id'] == product_id)
+            value = product['price'][0]['amount'] * quantity
+            items.append({
+                'id': product_id,
+                'product_id': product_id,
+                'name': product['name'],
+                'description': product['description'],
+                'quantity': quantity,
+                'meta': {'display_price': {'with_tax': {'value': {'amount': value, 'formatted': str(value)}}}},
+            })
+        return items
+
+    def get_cart_meta(self, cart_id):
+        total = sum(item['meta']['display_price']['with_tax']['value']['amount'] for item in self.get_cart_items(cart_id))
+        return {'display_price': {'with_tax': {'amount': total, 'currency': 'RUB', 'formatted': str(total)}}}
+
+
+def paginate(items, query):
+    limit = int(query.get('page[limit]', [100])[0])
+    offset = int(query.get('page[offset]', [0])[0])
+    return {'data': items[offset:offset + limit], 'meta': {'results': {'total': len(items)}}}
+
+
+def handle_moltin(state, method, path, query, body):
+    if path == '/oauth/access_token':
+        return 200, {'access_token': uuid.uuid4().hex, 'expires': int(time.time()) + 3600, 'expires_in': 3600}
+
+    with state.lock:
+        if path.rstrip('/') == '/v2/products':
+            return 200, paginate(state.products, query)
+
+        match = re.fullmatch(r'/v2/products/([^/]+)', path)
+        if match:
+            product = next((product for product in state.products if product['id'] == match[1]), None)
+            return (200, {'data': product}) if product else (404, {'errors': []})
+
+        match = re.fullmatch(r'/v2/files/([^/]+)', path)
+        if match:
+            return (200, {'data': state.files[match[1]]}) if match[1] in state.files else (404, {'errors': []})
+
+        match = re.fullmatch(r'/v2/flows/([^/]+)/entries', path)
+        if match and method == 'GET':
+            return 200, paginate(list(state.entries.setdefault(match[1], {}).values()), query)
+        if match and method == 'POST':
+            entry_id = str(uuid.uuid4())
+            entry = {**body['data'], 'id': entry_id}
+            state.entries.setdefault(match[1], {})[entry_id] = entry
+            return 201, {'data': entry}
+
+        match = re.fullmatch(r'/v2/flows/([^/]+)/entries/([^/]+)', path)
+        if match:
+            entry = state.entries.get(match[1], {}).get(match[2])
+            return (200, {'data': entry}) if entry else (404, {'errors': []})
+
+        match = re.fullmatch(r'/v2/carts/([^/]+)', path)
+        if match:
+            return 200, {'data': {'id': match[1], 'meta': state.get_cart_meta(match[1])}}
+
+        match = re.fullmatch(r'/v2/carts/([^/]+)/items(?:/([^/]+))?', path)
+        if match:
+            cart_id, item_id = match.groups()
+            cart = state.carts.setdefault(cart_id, {})
+            if method == 'POST':
+                product_id = body['data']['id']
+                cart[product_id] = cart.get(product_id, 0) + body['data'].get('quantity', 1)
+            elif method == 'DELETE':
+                cart.pop(item_id, None)
+            return 200, {'data': state.get_cart_items(cart_id), 'meta': state.get_cart_meta(cart_id)}
+
+    return 404, {'errors': [{'title': f'No stub for {method} {path}'}]}
+
+
+def handle_telegram(state, method, path, query, body):
+    bot_method = path.rsplit('/', 1)[-1]
+    if bot_method in ('deleteMessage', 'answerCallbackQuery', 'setWebhook'):
+        return 200, {'ok': True, 'result': True}
+
+    chat_id = int(body.get('chat_id', 0))
+    message = {
+        'message_id': int(body.get('message_id') or next(state.message_ids)),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+    }
+    if bot_method.startswith('edit'):
+        message['edit_date'] = int(time.time())
+    if bot_method in ('sendPhoto', 'editMessageMedia'):
+        message['photo'] = [{'file_id': f'file-{uuid.uuid4().hex}', 'width': 800, 'height': 600}]
+        message['caption'] = body.get('caption', '')
+    elif bot_method == 'sendLocation':
+        message['location'] = {'latitude': float(body['latitude']), 'longitude': float(body['longitude'])}
+    else:
+        message['text'] = body.get('text', '')
+    return 200, {'ok': True, 'result': message}
+
+
+def handle_yandex(state, method, path, query, body):
+    place = query.get('geocode', [''])[0]
+    if 'nowhere' in place:
+        members = []
+    else:
+        place_hash = zlib.crc32(place.encode())
+        latitude = MOSCOW[0] + (place_hash % 1000 - 500) / 5000
+        longitude = MOSCOW[1] + (place_hash // 1000 % 1000 - 500) / 5000
+        members = [{'GeoObject': {'Point': {'pos': f'{longitude} {latitude}'}}}]
+    return 200, {'response': {'GeoObjectCollection': {'featureMember': members}}}
+
+
+def create_request_handler(state, handle, latency=0.0, error_rate=0.0):
+    class StubRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self, method):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            raw_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            body = {}
+            if raw_body and 'json' in self.headers.get('Content-Type', ''):
+                body = json.loads(raw_body)
+            elif raw_body and 'form-urlencoded' in self.headers.get('Content-Type', ''):
+                body = {key: values[0] for key, values in parse_qs(raw_body.decode()).items()}
+
+            if latency:
+                time.sleep(random.expovariate(1 / latency))
+
+            if random.random() < error_rate:
+                status, payload = 503, {'errors': [{'title': 'Injected error'}]}
+            else:
+                status, payload = handle(state, method, url.path, query, body)
+
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.respond('GET')
+
+        def do_POST(self):
+            self.respond('POST')
+
+        def do_PUT(self):
+            self.respond('PUT')
+
+        def do_DELETE(self):
+            self.respond('DELETE')
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubRequestHandler
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def start_stub(state, handle, port=0, latency=0.0, error_rate=0.0):
+    server = StubServer(('127.0.0.1', port), create_request_handler(state, handle, latency, error_rate))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_stubs(state, moltin_latency=0.0, telegram_latency=0.0, yandex_latency=0.0, error_rate=0.0, ports=(0, 0, 0)):
+    """Start the three stubs and return the URLs to point the bot at."""
+    moltin = start_stub(state, handle_moltin, ports[0], moltin_latency, error_rate)
+    telegram = start_stub(state, handle_telegram, ports[1], telegram_latency, error_rate)
+    yandex = start_stub(state, handle_yandex, ports[2], yandex_latency, error_rate)
+    return {
+        'MOLTIN_API_URL': f'http://127.0.0.1:{moltin.server_port}',
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{telegram.server_port}/bot',
+        'YANDEX_GEOCODER_URL': f'http://127.0.0.1:{yandex.server_port}/1.x',
+    }
+
+
+def create_arg_parser():
+    parser = argparse.ArgumentParser(description='Run local Moltin, Telegram and Yandex stubs')
+    parser.add_argument('--ports', type=int, nargs=3, default=(8001, 8002, 8003), metavar=('MOLTIN', 'TELEGRAM', 'YANDEX'))
+    parser.add_argument('--latency', type=float, default=0.05, help='Mean upstream latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with 503')
+    parser.add_argument('--products', type=int, default=30)
+    parser.add_argument('--pizzerias', type=int, default=50)
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_arg_parser().parse_args()
+    state = StubState(args.products, args.pizzerias)
+    urls = start_stubs(state, args.latency, args.latency, args.latency, args.error_rate, args.ports)
+    for name, url in urls.items():
+        print(f'{name}={url}')
+
+    threading.Event().wait()
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import Counter
+
+import requests
+
+
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+
+def is_upstream_failure(error):
+    """Timeouts, connection errors, 429 and 5xx count against the upstream, other 4xx do not."""
+    if not isinstance(error, requests.RequestException):
+        return False
+
+    response = getattr(error, 'response', None)
+    return response is None or response.status_code == 429 or response.status_code >= 500
+
+
+class CircuitBreaker:
+    """Fail fast after `failure_threshold` upstream failures in a row.
+
+    After `reset_timeout` seconds one trial call is let through: success closes
+    the circuit, failure opens it for another `reset_timeout`.
+    """
+
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_running = False
+        self.stats = Counter()
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.trial_running = False
+
+            if self.state == OPEN or (self.state == HALF_OPEN and self.trial_running):
+                self.stats['rejected'] += 1
+                raise CircuitOpenError(f'{self.name} circuit is open')
+
+            if self.state == HALF_OPEN:
+                self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = CLOSED
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.stats['failures'] += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != OPEN:
+                    self.stats['opened'] += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+
+    def __enter__(self):
+        self.before_call()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if isinstance(exc_value, CircuitOpenError):
+            with self.lock:
+                self.trial_running = False
+        elif exc_value is not None and is_upstream_failure(exc_value):
+            self.record_failure()
+        else:
+            self.record_success()
+        return False
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                f'{self.name}:state': STATE_VALUES[self.state],
+                f'{self.name}:consecutive_failures': self.failures,
+                **{f'{self.name}:{stat}': value for stat, value in self.stats.items()},
+            }
+
+
+def get_breaker(name, **kwargs):
+    with breakers_lock:
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name, **kwargs)
+        return breakers[name]
+
+
+def get_stats():
+    stats = {}
+    for circuit_breaker in list(breakers.values()):
+        stats.update(circuit_breaker.get_stats())
+    return stats
@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+LOCAL_CACHE_SIZE = 4096
+LOCAL_TTL = 60
+LOCK_TIMEOUT = 30
+
+_local_cache = OrderedDict()
+_local_lock = threading.Lock()
+_missing = object()
+
+stats = Counter()
+stats_lock = threading.Lock()
+
+
+def count(stat, value=1):
+    with stats_lock:
+        stats[stat] += value
+
+
+def get_local(key):
+    with _local_lock:
+        item = _local_cache.get(key)
+        if item is None:
+            return _missing
+
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del _local_cache[key]
+            return _missing
+
+        _local_cache.move_to_end(key)
+        return value
+
+
+def set_local(key, value, ttl=LOCAL_TTL):
+    with _local_lock:
+        _local_cache[key] = (value, time.monotonic() + ttl)
+        _local_cache.move_to_end(key)
+        while len(_local_cache) > LOCAL_CACHE_SIZE:
+            _local_cache.popitem(last=False)
+
+
+def get_or_set(db, key, fetch, ttl, local_ttl=LOCAL_TTL):
+    """Read-through cache: in-process LRU, then Redis, then `fetch`.
+
+    Only one caller across all processes runs `fetch` for a missing key,
+    the others wait on a Redis lock and read the refilled value. `None`
+    results are cached too.
+    """
+    namespace = key.split(':', 1)[0]
+    value = get_local(key)
+    if value is not _missing:
+        count(f'{namespace}:local_hits')
+        return value
+
+    raw_value = db.get(key)
+    if raw_value is None:
+        with db.lock(f'{key}:lock', timeout=LOCK_TIMEOUT, blocking_timeout=LOCK_TIMEOUT):
+            raw_value = db.get(key)
+            if raw_value is None:
+                count(f'{namespace}:misses')
+                raw_value = json.dumps(fetch())
+                db.set(key, raw_value, ex=ttl)
+            else:
+                count(f'{namespace}:hits')
+    else:
+        count(f'{namespace}:hits')
+
+    value = json.loads(raw_value)
+    set_local(key, value, min(ttl, local_ttl))
+    return value
+
+
+def invalidate(db, pattern):
+    with _local_lock:
+        for key in [key for key in _local_cache if key.startswith(pattern.rstrip('*'))]:
+            del _local_cache[key]
+
+    keys = [key for key in db.scan_iter(match=pattern) if not key.endswith(':lock')]
+    if keys:
+        db.delete(*keys)
+
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
@@ -0,0 +1,57 @@
+import hashlib
+import json
+
+import requests
+
+import breaker
+import cache
+import elasticpath
+
+
+CATALOG_TTL = 24 * 60 * 60
+# Outside the catalog:* namespace, so that it survives `invalidate`
+STALE_MENU_KEY = 'stale:catalog:menu'
+
+
+def fetch_menu(token):
+    products = elasticpath.get_all_products(token)
+    version = hashlib.sha1(json.dumps(products, sort_keys=True).encode()).hexdigest()[:12]
+    return {'version': version, 'products': products}
+
+
+def get_menu(db, token):
+    """Return the cached menu, or the last menu fetched while Moltin is failing."""
+    def fetch():
+        menu = fetch_menu(token)
+        db.set(STALE_MENU_KEY, json.dumps(menu))
+        return menu
+
+    try:
+        return cache.get_or_set(db, 'catalog:menu', fetch, CATALOG_TTL)
+    except (breaker.CircuitOpenError, requests.RequestException):
+        stale_menu = db.get(STALE_MENU_KEY)
+        if stale_menu is None:
+            raise
+        return json.loads(stale_menu)
+
+
+def get_products(db, token):
+    return get_menu(db, token)['products']
+
+
+def get_product(db, token, product_id):
+    for product in get_products(db, token):
+        if product['id'] == product_id:
+            return {'data': product}
+
+    return cache.get_or_set(
+        db, f'catalog:product:{product_id}', lambda: elasticpath.get_products(token, product_id), CATALOG_TTL)
+
+
+def get_image_url(db, token, image_id):
+    return cache.get_or_set(
+        db, f'catalog:image:{image_id}', lambda: elasticpath.get_image_url(token, image_id), CATALOG_TTL)
+
+
+def invalidate(db):
+    cache.invalidate(db, 'catalog:*')
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+
+from redis.exceptions import LockError
+
+import breaker
+import elasticpath
+
+
+PENDING_KEY = 'customers:pending'
+FLUSH_LOCK_KEY = 'customers:flush:lock'
+CUSTOMER_TTL = 7 * 24 * 60 * 60
+
+FLUSH_INTERVAL = 5
+BATCH_SIZE = 50
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 30 * 60
+
+logger = logging.getLogger('telegram_shop')
+
+stats = Counter()
+stats_lock = threading.Lock()
+
+
+def count(stat, value=1):
+    with stats_lock:
+        stats[f'customers:{stat}'] += value
+
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+
+def get_customer_key(customer_id):
+    return f'customer:{customer_id}'
+
+
+def save_customer(db, customer_data):
+    """Store the customer under a new local id and queue it for the Customer flow, in one round trip."""
+    customer_id = uuid.uuid4().hex
+    key = get_customer_key(customer_id)
+    with db.pipeline(transaction=False) as pipe:
+        pipe.hset(key, mapping=customer_data)
+        pipe.expire(key, CUSTOMER_TTL)
+        pipe.zadd(PENDING_KEY, {customer_id: time.time()})
+        pipe.execute()
+
+    count('saved')
+    return customer_id
+
+
+def get_customer(db, customer_id):
+    return db.hgetall(get_customer_key(customer_id))
+
+
+def write_customer(token, customer):
+    values = {field: value for field, value in customer.items() if field not in ('entry_id', 'attempts')}
+    values['Latitude'] = float(values['Latitude'])
+    values['Longitude'] = float(values['Longitude'])
+    return elasticpath.create_entry(token, 'Customer', values)['data']['id']
+
+
+def flush(db, token):
+    """Write one batch of due customers to Moltin, reschedule the failed ones with backoff."""
+    customer_ids = db.zrangebyscore(PENDING_KEY, '-inf', time.time(), start=0, num=BATCH_SIZE)
+    if not customer_ids:
+        return 0
+
+    with db.pipeline(transaction=False) as pipe:
+        for customer_id in customer_ids:
+            pipe.hgetall(get_customer_key(customer_id))
+        customers = pipe.execute()
+
+    futures = {
+        customer_id: elasticpath.executor.submit(write_customer, token, customer)
+        for customer_id, customer in zip(customer_ids, customers) if customer and not customer.get('entry_id')
+    }
+
+    with db.pipeline(transaction=False) as pipe:
+        for customer_id, customer in zip(customer_ids, customers):
+            key = get_customer_key(customer_id)
+            if customer_id not in futures:
+                pipe.zrem(PENDING_KEY, customer_id)
+                continue
+
+            try:
+                entry_id = futures[customer_id].result()
+            except Exception as error:
+                if not breaker.is_upstream_failure(error):
+                    # Rejected by Moltin, retrying the same values would fail again
+                    logger.error(f'Customer {customer_id} write rejected: {error}')
+                    pipe.zrem(PENDING_KEY, customer_id)
+                    count('rejected')
+                    continue
+
+                attempts = int(customer.get('attempts', 0)) + 1
+                logger.warning(f'Customer {customer_id} write failed (attempt {attempts}): {error}')
+                pipe.hset(key, 'attempts', attempts)
+                pipe.zadd(PENDING_KEY, {customer_id: time.time() + min(RETRY_DELAY * 2 ** attempts, MAX_RETRY_DELAY)})
+                count('failed')
+            else:
+                pipe.hset(key, 'entry_id', entry_id)
+                pipe.zrem(PENDING_KEY, customer_id)
+                count('written')
+        pipe.execute()
+
+    return len(customer_ids)
+
+
+def run_flusher(db, get_token, stop_event=None):
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        try:
+            # One flusher at a time, so that no customer is written twice
+            with db.lock(FLUSH_LOCK_KEY, timeout=5 * 60, blocking_timeout=0):
+                while flush(db, get_token()) == BATCH_SIZE:
+                    pass
+        except LockError:
+            pass
+        except Exception as error:
+            logger.error(f'Customer flush failed: {error}')
+        stop_event.wait(FLUSH_INTERVAL)
+
+
+def start_flusher(db, get_token):
+    thread = threading.Thread(target=run_flusher, args=(db, get_token), daemon=True)
+    thread.start()
+    return thread
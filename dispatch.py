@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import Counter
+
+import redis
+
+
+STREAM_KEY = 'orders'
+DEAD_LETTER_KEY = 'orders:dead'
+PROGRESS_KEY = 'orders:progress'
+PROGRESS_TTL = 24 * 60 * 60
+DISPATCHED_KEY = 'orders:dispatched'
+DISPATCHED_TTL = 24 * 60 * 60
+GROUP = 'dispatchers'
+STREAM_MAXLEN = 100000
+
+BATCH_SIZE = 10
+BLOCK_MS = 5000
+RETRY_IDLE_MS = 30 * 1000
+MAX_DELIVERIES = 5
+
+logger = logging.getLogger('telegram_shop')
+
+stats = Counter()
+stats_lock = threading.Lock()
+
+
+def count(stat, value=1):
+    with stats_lock:
+        stats[f'orders:{stat}'] += value
+
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+
+def get_consumer_name(number=0):
+    return f'{socket.gethostname()}-{os.getpid()}-{number}'
+
+
+def ensure_group(db):
+    try:
+        db.xgroup_create(STREAM_KEY, GROUP, id='0', mkstream=True)
+    except redis.ResponseError as error:
+        if 'BUSYGROUP' not in str(error):
+            raise
+
+
+def enqueue_order(db, order):
+    """Queue an order for the dispatchers and return its stream id."""
+    order = {**order, 'created_at': time.time()}
+    count('queued')
+    return db.xadd(STREAM_KEY, {'order': json.dumps(order)}, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+def get_progress_key(message_id):
+    return f'{PROGRESS_KEY}:{message_id}'
+
+
+def get_dispatched_key(message_id):
+    return f'{DISPATCHED_KEY}:{message_id}'
+
+
+def is_dispatched(db, message_id):
+    """Whether every step of the order ran, as opposed to still pending or dead-lettered."""
+    return bool(db.exists(get_dispatched_key(message_id)))
+
+
+def dead_letter(db, message_id, fields, error):
+    with db.pipeline() as pipe:
+        pipe.xadd(DEAD_LETTER_KEY, {**fields, 'message_id': message_id, 'error': str(error)})
+        pipe.xack(STREAM_KEY, GROUP, message_id)
+        pipe.delete(get_progress_key(message_id))
+        pipe.execute()
+    count('dead')
+    logger.error(f'Order {message_id} moved to {DEAD_LETTER_KEY}: {error}')
+
+
+def run_steps(db, message_id, order, steps, *args):
+    """Run the order's steps in turn, skipping those a previous delivery already finished."""
+    progress_key = get_progress_key(message_id)
+    done = db.smembers(progress_key)
+    for step, handle_step in steps:
+        if step in done:
+            continue
+        handle_step(*args, order)
+        with db.pipeline(transaction=False) as pipe:
+            pipe.sadd(progress_key, step)
+            pipe.expire(progress_key, PROGRESS_TTL)
+            pipe.execute()
+
+
+def process_message(db, message_id, fields, steps, *args):
+    try:
+        order = {**json.loads(fields['order']), 'id': message_id}
+        run_steps(db, message_id, order, steps, *args)
+    except Exception as error:
+        pending = db.xpending_range(STREAM_KEY, GROUP, min=message_id, max=message_id, count=1)
+        deliveries = pending[0]['times_delivered'] if pending else MAX_DELIVERIES
+        if deliveries >= MAX_DELIVERIES:
+            dead_letter(db, message_id, fields, error)
+        else:
+            # Left pending, it is claimed again once idle for RETRY_IDLE_MS
+            count('failed')
+            logger.warning(f'Order {message_id} failed (delivery {deliveries}): {error}')
+        return
+
+    with db.pipeline() as pipe:
+        pipe.xack(STREAM_KEY, GROUP, message_id)
+        pipe.delete(get_progress_key(message_id))
+        pipe.set(get_dispatched_key(message_id), 1, ex=DISPATCHED_TTL)
+        pipe.execute()
+    count('dispatched')
+
+
+def read_messages(db, consumer):
+    """Reclaim orders that stayed unacknowledged too long, otherwise wait for new ones."""
+    # Redis 7 also returns the ids of deleted entries, 6.2 returns only [next_id, messages]
+    messages = db.xautoclaim(STREAM_KEY, GROUP, consumer, RETRY_IDLE_MS, start_id='0-0', count=BATCH_SIZE)[1]
+    if messages:
+        count('retried', len(messages))
+        return messages
+
+    response = db.xreadgroup(GROUP, consumer, {STREAM_KEY: '>'}, count=BATCH_SIZE, block=BLOCK_MS)
+    return response[0][1] if response else []
+
+
+def run_dispatcher(db, consumer, steps, *args, stop_event=None):
+    """Consume orders until stopped, running `steps`, a list of (name, handler(*args, order))."""
+    stop_event = stop_event or threading.Event()
+    logger.info(f'Dispatcher {consumer} consuming {STREAM_KEY}')
+
+    group_ready = False
+    while not stop_event.is_set():
+        try:
+            if not group_ready:
+                ensure_group(db)
+                group_ready = True
+            for message_id, fields in read_messages(db, consumer):
+                if fields:
+                    process_message(db, message_id, fields, steps, *args)
+                else:
+                    db.xack(STREAM_KEY, GROUP, message_id)
+        except Exception as error:
+            # Orders not acknowledged yet stay pending and are reclaimed later
+            logger.error(f'Dispatcher {consumer} failed: {error}')
+            stop_event.wait(1)
+
+
+def start_dispatchers(db, consumers, steps, *args):
+    threads = []
+    for number in range(consumers):
+        thread = threading.Thread(
+            target=run_dispatcher, args=(db, get_consumer_name(number), steps, *args), daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
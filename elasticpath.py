@@ -1,43 +1,222 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
 import requests
+from requests.adapters import HTTPAdapter
 from slugify import slugify
+from urllib3.util.retry import Retry
+
+import breaker
+import metrics
+import ratelimit
+
+
+API_URL = os.getenv('MOLTIN_API_URL', 'https://api.moltin.com')
+TIMEOUT = 10
+CONNECT_TIMEOUT = 3.05
+# Read timeout budgets of the calls made while a customer waits, by metrics endpoint
+TIMEOUTS = {
+    'POST /oauth/access_token': 5,
+    'GET /v2/products': 5,
+    'GET /v2/products/{id}': 3,
+    'GET /v2/files/{id}': 3,
+    'GET /v2/carts/{id}': 3,
+    'GET /v2/carts/{id}/items': 3,
+    'POST /v2/carts/{id}/items': 5,
+    'DELETE /v2/carts/{id}/items/{id}': 5,
+    'GET /v2/flows/Pizzeria/entries': 5,
+}
+HEDGE_DELAY = float(os.getenv('MOLTIN_HEDGE_DELAY', 0))
+POOL_SIZE = 20
+PAGE_LIMIT = 100
+TOKEN_KEY = 'elasticpath_token'
+TOKEN_REFRESH_MARGIN = 5 * 60
+
+logger = logging.getLogger('elasticpath')
+
+
+class RateLimitRetry(Retry):
+    """Retry 429 for every method: a rate-limited request was never processed."""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if status_code == 429:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def create_session():
+    # A read timeout is not retried, so that a hung Moltin costs one timeout budget per call
+    retries = RateLimitRetry(
+        total=3,
+        connect=1,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retries)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+session = create_session()
+executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+hedge_executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+moltin_breaker = breaker.get_breaker('moltin')
+
+oauth_token = {'access_token': None, 'expires': 0}
+oauth_token_lock = threading.Lock()
+credentials = {}
+
+
+def send(method, path, headers, timeout, **kwargs):
+    ratelimit.acquire('moltin')
+    return session.request(method, f'{API_URL}{path}', headers=headers, timeout=timeout, **kwargs)
+
+
+def send_hedged(method, path, headers, timeout, **kwargs):
+    """Send the request again if it has not answered within HEDGE_DELAY, return the first answer."""
+    futures = [hedge_executor.submit(send, method, path, headers, timeout, **kwargs)]
+    done, _ = wait(futures, timeout=HEDGE_DELAY)
+    if not done:
+        metrics.hedged_requests.labels('moltin').inc()
+        futures.append(hedge_executor.submit(send, method, path, headers, timeout, **kwargs))
+
+    error = None
+    for future in as_completed(futures):
+        try:
+            return future.result()
+        except requests.RequestException as future_error:
+            error = future_error
+    raise error
+
+
+def request(method, path, token=None, timeout=None, **kwargs):
+    """Call Moltin within the endpoint's timeout budget, failing fast while its circuit is open.
+
+    With MOLTIN_HEDGE_DELAY set, slow GETs are hedged with a duplicate request.
+    """
+    headers = kwargs.pop('headers', {})
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+
+    endpoint = metrics.get_endpoint(method, path)
+    timeout = timeout or (CONNECT_TIMEOUT, TIMEOUTS.get(endpoint, TIMEOUT))
+    send_request = send_hedged if method == 'GET' and HEDGE_DELAY else send
+
+    with metrics.track_upstream('moltin', endpoint), moltin_breaker:
+        response = send_request(method, path, headers, timeout, **kwargs)
+        if response.status_code == 401 and token and credentials:
+            token = refresh_oauth_access_token(stale_token=token, **credentials)
+            headers['Authorization'] = f'Bearer {token}'
+            response = send_request(method, path, headers, timeout, **kwargs)
+
+        response.raise_for_status()
+        return response
+
+
+def iterate_pages(token, path, limit=PAGE_LIMIT, prefetch=False):
+    """Yield every item of a paginated list endpoint, one page in memory at a time.
+
+    With `prefetch` the next page is requested while the current one is consumed.
+    """
+    def fetch_page(offset):
+        params = {'page[limit]': limit, 'page[offset]': offset}
+        return request('GET', path, token, params=params).json()
+
+    offset = 0
+    page_future = executor.submit(fetch_page, offset) if prefetch else None
+    while True:
+        page = page_future.result() if prefetch else fetch_page(offset)
+        items = page['data']
+        total = page.get('meta', {}).get('results', {}).get('total')
+        offset += limit
+        has_next = offset < total if total is not None else len(items) == limit
+
+        if has_next and prefetch:
+            page_future = executor.submit(fetch_page, offset)
+
+        yield from items
+
+        if not has_next:
+            return
+
+
+def refresh_oauth_access_token(db, client_id, client_secret, stale_token=None):
+    """Reload the token from Redis, or get a new one from Moltin if Redis has none fresher.
+
+    The Redis lock makes only one process at a time ask Moltin for a token.
+    """
+    with db.lock(f'{TOKEN_KEY}:lock', timeout=TIMEOUT * 3, blocking_timeout=TIMEOUT * 3):
+        with db.pipeline() as pipe:
+            access_token, ttl = pipe.get(TOKEN_KEY).ttl(TOKEN_KEY).execute()
+
+        if access_token and access_token != stale_token and ttl > TOKEN_REFRESH_MARGIN:
+            expires = time.time() + ttl
+        else:
+            data = {
+                'client_id': client_id,
+                'client_secret': client_secret,
+                'grant_type': 'client_credentials'
+            }
+            response = request('POST', '/oauth/access_token', data=data)
+            access_token = response.json()['access_token']
+            expires = response.json()['expires']
+            db.set(TOKEN_KEY, access_token, ex=max(int(expires - time.time()), 1))
 
+    oauth_token.update(access_token=access_token, expires=expires)
+    return access_token
 
-def get_oauth_access_token(db, client_id, client_secret, expires=3000):
-    access_token = db.get('elasticpath_token')
 
-    if access_token:
-        return access_token
+def refresh_oauth_access_token_in_background(**credentials):
+    try:
+        refresh_oauth_access_token(stale_token=oauth_token['access_token'], **credentials)
+    except Exception as error:
+        logger.error(f'Background token refresh failed: {error}')
+    finally:
+        oauth_token_lock.release()
 
-    data = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post('https://api.moltin.com/oauth/access_token', data=data)
-    response.raise_for_status()
-    access_token = response.json()['access_token']
-    db.set('elasticpath_token', access_token, ex=expires)
-    return access_token
+
+def get_oauth_access_token(db, client_id, client_secret):
+    """Return the in-memory token, refreshing it ahead of expiry without blocking callers."""
+    credentials.update(db=db, client_id=client_id, client_secret=client_secret)
+    time_left = oauth_token['expires'] - time.time()
+
+    if time_left > TOKEN_REFRESH_MARGIN:
+        return oauth_token['access_token']
+
+    if time_left > 0:
+        if oauth_token_lock.acquire(blocking=False):
+            threading.Thread(
+                target=refresh_oauth_access_token_in_background, kwargs=credentials, daemon=True).start()
+        return oauth_token['access_token']
+
+    with oauth_token_lock:
+        if oauth_token['expires'] - time.time() > 0:
+            return oauth_token['access_token']
+        return refresh_oauth_access_token(db, client_id, client_secret)
 
 
 def create_file(token, file, file_name, public=True):
-    url = 'https://api.moltin.com/v2/files/'
-    headers = {'Authorization': f'Bearer {token}'}
+    path = '/v2/files/'
 
     files = {
         'file': (file_name, file),
         'public': public
     }
     
-    response = requests.post(url, headers=headers, files=files)
-    response.raise_for_status()
+    response = request('POST', path, token, files=files)
 
     return response.json()
 
 
 def create_product(token, product_id, name, description, price):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = 'https://api.moltin.com/v2/products/'
+    path = '/v2/products/'
 
     payload = {
         'data': {
@@ -59,14 +238,41 @@ def create_product(token, product_id, name, description, price):
         }
     }
 
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    response = request('POST', path, token, json=payload)
     return response.json()
 
 
+def update_product(token, product_id, name, description, price):
+    path = f'/v2/products/{product_id}'
+
+    payload = {
+        'data': {
+            'type': 'product',
+            'id': product_id,
+            'name': name,
+            'slug': slugify(name),
+            'description': description,
+            'price': [
+                {
+                    'amount': price,
+                    'currency': 'RUB',
+                    'includes_tax': True,
+                }
+            ],
+        }
+    }
+
+    response = request('PUT', path, token, json=payload)
+    return response.json()
+
+
+def delete_product(token, product_id):
+    path = f'/v2/products/{product_id}'
+    request('DELETE', path, token)
+
+
 def create_main_image_relationship(token, product_id, image_id):
-    url = f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image'
-    headers = {'Authorization': f'Bearer {token}'}
+    path = f'/v2/products/{product_id}/relationships/main-image'
 
     payload = {
         'data': {
@@ -75,14 +281,12 @@ def create_main_image_relationship(token, product_id, image_id):
         }
     }
 
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    response = request('POST', path, token, json=payload)
     return response.json()
 
 
 def create_flow(token, name, description):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = 'https://api.moltin.com/v2/flows/'
+    path = '/v2/flows/'
 
     payload = {
         'data': {
@@ -94,14 +298,12 @@ def create_flow(token, name, description):
         }
     }
 
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    response = request('POST', path, token, json=payload)
     return response.json()
 
 
 def create_entry(token, flow_slug, values):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
+    path = f'/v2/flows/{flow_slug}/entries'
 
     payload = {
         'data': {
@@ -111,33 +313,50 @@ def create_entry(token, flow_slug, values):
         }
     }
 
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    response = request('POST', path, token, json=payload)
+    return response.json()
+
+
+def update_entry(token, flow_slug, entry_id, values):
+    path = f'/v2/flows/{flow_slug}/entries/{entry_id}'
+
+    payload = {
+        'data': {
+            'type': 'entry',
+            'id': entry_id,
+            **values,
+        }
+    }
+
+    response = request('PUT', path, token, json=payload)
     return response.json()
 
 
 def get_entry(token, slug, id):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/flows/{slug}/entries/{id}'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    path = f'/v2/flows/{slug}/entries/{id}'
+    response = request('GET', path, token)
     entry = response.json()
     return entry['data']
 
 
+def iterate_entries(token, slug, prefetch=True):
+    return iterate_pages(token, f'/v2/flows/{slug}/entries', prefetch=prefetch)
+
+
 def get_all_entries(token, slug):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/flows/{slug}/entries'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    entries = response.json()['data']
     return [
-        {'Address': entry['Address'], 'coordinates': (entry['Latitude'], entry['Longitude']), 'id': entry['id']} for entry in entries]
+        {
+            'Address': entry['Address'],
+            'coordinates': (entry['Latitude'], entry['Longitude']),
+            'id': entry['id'],
+            'DeliverTelegramID': entry.get('DeliverTelegramID'),
+        }
+        for entry in iterate_entries(token, slug)
+    ]
 
 
 def create_flow_field(token, name, field_type, description, flow_id):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = 'https://api.moltin.com/v2/fields/'
+    path = '/v2/fields/'
 
     relationships = {
         'flow': {
@@ -161,27 +380,32 @@ def create_flow_field(token, name, field_type, description, flow_id):
         }
     }
 
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    response = request('POST', path, token, json=payload)
     return response.json()
 
 
 def get_products(token, product_id=None, limit=5, offset=0):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/products/'
+    path = '/v2/products/'
+    params = None
 
     if product_id:
-        url += product_id
+        path += product_id
     else:
-        url += f'?page[limit]={limit}&page[offset]={offset}/'
-    
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+        params = {'page[limit]': limit, 'page[offset]': offset}
+
+    response = request('GET', path, token, params=params)
     return response.json()
 
 
+def iterate_products(token, prefetch=True):
+    return iterate_pages(token, '/v2/products', prefetch=prefetch)
+
+
+def get_all_products(token):
+    return list(iterate_products(token))
+
+
 def add_product_to_cart(token, cart, product_id, quantity=1):
-    headers = {'Authorization': f'Bearer {token}'}
     payload = {
         "data": {
             "id": product_id,
@@ -190,33 +414,32 @@ def add_product_to_cart(token, cart, product_id, quantity=1):
         }
     }
 
-    url = f'https://api.moltin.com/v2/carts/{cart}/items'
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    path = f'/v2/carts/{cart}/items'
+    response = request('POST', path, token, json=payload)
     return response.json()
 
 
 def get_a_cart(token, cart):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/carts/{cart}'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    path = f'/v2/carts/{cart}'
+    response = request('GET', path, token)
     return response.json()['data']
 
 
 def get_cart_items(token, cart):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/carts/{cart}/items'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    path = f'/v2/carts/{cart}/items'
+    response = request('GET', path, token)
     return response.json()['data']
 
 
+def get_cart_with_items(token, cart):
+    cart_future = executor.submit(get_a_cart, token, cart)
+    cart_items_future = executor.submit(get_cart_items, token, cart)
+    return cart_future.result(), cart_items_future.result()
+
+
 def remove_cart_item(token, cart, product_id):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/carts/{cart}/items/{product_id}'
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+    path = f'/v2/carts/{cart}/items/{product_id}'
+    response = request('DELETE', path, token)
     return response.json()
 
 
@@ -249,11 +472,13 @@ def get_formatted_cart_items_without_description(cart, cart_items):
     return '\n'.join(items)
 
 
+def iterate_files(token, prefetch=True):
+    return iterate_pages(token, '/v2/files', prefetch=prefetch)
+
+
 def get_image_url(token, image_id):
-    headers = {'Authorization': f'Bearer {token}'}
-    url = f'https://api.moltin.com/v2/files/{image_id}'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
+    path = f'/v2/files/{image_id}'
+    response = request('GET', path, token)
     return response.json()['data']['link']['href']
 
 
@@ -266,8 +491,7 @@ def get_product_markdown_output(product):
 
 
 def create_customer(token, name, email, customer_type='customer'):
-    url = 'https://api.moltin.com/v2/customers'
-    headers = {'Authorization': f'Bearer {token}'}
+    path = '/v2/customers'
     payload = {
         "data": {
             "name": name,
@@ -275,6 +499,5 @@ def create_customer(token, name, email, customer_type='customer'):
             "type": customer_type
         }
     }
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
+    response = request('POST', path, token, json=payload)
     return response.json()
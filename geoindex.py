@@ -0,0 +1,179 @@
+import math
+
+import numpy as np
+
+
+EARTH_RADIUS = 6371.0088
+# Up to this many cell to pizzeria distances, zones are built in one pass instead of by blocks
+DENSE_DISTANCES = 2_000_000
+
+
+def build_index(entries):
+    coordinates = np.radians(np.array([entry['coordinates'] for entry in entries], dtype=float).reshape(-1, 2))
+    return {
+        'entries': entries,
+        'latitudes': coordinates[:, 0],
+        'longitudes': coordinates[:, 1],
+        'cos_latitudes': np.cos(coordinates[:, 0]),
+    }
+
+
+def get_distances(index, coordinates):
+    latitude, longitude = np.radians(np.array(coordinates, dtype=float))
+    half_dlat = (index['latitudes'] - latitude) / 2
+    half_dlon = (index['longitudes'] - longitude) / 2
+    a = np.sin(half_dlat) ** 2 + np.cos(latitude) * index['cos_latitudes'] * np.sin(half_dlon) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def find_nearest(index, coordinates, k=1):
+    distances = get_distances(index, coordinates)
+    k = min(k, len(distances))
+    if not k:
+        return []
+
+    nearest = np.argpartition(distances, k - 1)[:k]
+    nearest = nearest[np.argsort(distances[nearest])]
+    return [(index['entries'][i], float(distances[i])) for i in nearest]
+
+
+def find_within(index, coordinates, radius):
+    distances = get_distances(index, coordinates)
+    within = np.flatnonzero(distances <= radius)
+    within = within[np.argsort(distances[within])]
+    return [(index['entries'][i], float(distances[i])) for i in within]
+
+
+def get_tier(limits, distance):
+    """Return the index of the first tier whose limit exceeds `distance`, or None when out of range."""
+    tier = int(np.searchsorted(limits, distance, side='right'))
+    return tier if tier < len(limits) else None
+
+
+def get_cell(zones, coordinates):
+    latitude, longitude = map(float, coordinates)
+    return int(latitude // zones['lat_step']), int(longitude // zones['lon_step'])
+
+
+def get_candidate_cells(index, max_radius, lat_step, lon_step):
+    """Cells within `max_radius` km of a pizzeria, enumerated by blocks so that nearby pizzerias share a window."""
+    cell_km = np.radians(lat_step) * EARTH_RADIUS
+    rows_span = int(np.ceil(max_radius / cell_km)) + 1
+    cols_span = int(np.ceil(max_radius / (cell_km * lon_step / lat_step * max(index['cos_latitudes'].min(), 0.01)))) + 1
+    rows = np.degrees(index['latitudes']) // lat_step
+    cols = np.degrees(index['longitudes']) // lon_step
+    blocks = np.unique(np.column_stack([rows // rows_span, cols // cols_span]).astype(int), axis=0)
+
+    cells = []
+    for block_row, block_col in blocks:
+        block_rows, block_cols = np.meshgrid(
+            np.arange((block_row - 1) * rows_span, (block_row + 2) * rows_span),
+            np.arange((block_col - 1) * cols_span, (block_col + 2) * cols_span))
+        cells.append(np.column_stack([block_rows.ravel(), block_cols.ravel()]))
+
+    return np.unique(np.concatenate(cells), axis=0)
+
+
+def get_pairwise_distances(latitudes, longitudes, index, positions):
+    """Distances in km from every point (in radians) to every pizzeria at `positions`, one row per point."""
+    half_dlat = (index['latitudes'][positions][None, :] - latitudes[:, None]) / 2
+    half_dlon = (index['longitudes'][positions][None, :] - longitudes[:, None]) / 2
+    a = (
+        np.sin(half_dlat) ** 2
+        + np.cos(latitudes)[:, None] * index['cos_latitudes'][positions][None, :] * np.sin(half_dlon) ** 2
+    )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def group_cells(cells, block_cells):
+    """Split cells into square blocks of `block_cells` x `block_cells`."""
+    _, block_numbers = np.unique(cells // block_cells, axis=0, return_inverse=True)
+    block_numbers = block_numbers.ravel()
+    order = np.argsort(block_numbers, kind='stable')
+    return np.split(cells[order], np.cumsum(np.bincount(block_numbers))[:-1])
+
+
+def build_zones(index, tiers, cell_size=0.5, block_cells=8):
+    """Precompute the nearest pizzeria and delivery tier of every grid cell in delivery range.
+
+    `tiers` is a list of (max_km, price) sorted by distance. A cell is stored only when
+    every point inside it has the same nearest pizzeria and the same tier, so cells on a
+    tier boundary or between two pizzerias are left out and `find_zone` checks them exactly.
+
+    Cells are handled in blocks of `block_cells` x `block_cells`, each against only the
+    pizzerias that can be nearest or second nearest to one of its cells.
+    """
+    limits = np.array([max_km for max_km, _ in tiers], dtype=float)
+    entries = index['entries']
+    lat_step = np.degrees(cell_size / EARTH_RADIUS)
+    reference_cos = float(np.mean(index['cos_latitudes'])) if entries else 1.0
+    lon_step = lat_step / max(reference_cos, 0.01)
+    zones = {'index': index, 'limits': limits, 'lat_step': lat_step, 'lon_step': lon_step, 'cells': {}}
+    if not entries or not len(limits):
+        return zones
+
+    all_positions = np.arange(len(entries))
+    candidates = get_candidate_cells(index, limits[-1], lat_step, lon_step)
+    if len(candidates) * len(entries) <= DENSE_DISTANCES:
+        groups = [candidates]
+    else:
+        groups = group_cells(candidates, block_cells)
+
+    for cells in groups:
+        latitudes = np.radians((cells[:, 0] + 0.5) * lat_step)
+        longitudes = np.radians((cells[:, 1] + 0.5) * lon_step)
+        cos_latitudes = np.cos(latitudes)
+        cells_index = {'latitudes': latitudes, 'longitudes': longitudes, 'cos_latitudes': cos_latitudes}
+
+        # Distance to the nearest pizzeria changes by at most the half diagonal within a cell
+        half_diagonals = np.hypot(cell_size / 2, np.radians(lon_step / 2) * EARTH_RADIUS * cos_latitudes) * 1.01
+
+        # A pizzeria farther than `reach` from the block center is neither of the two nearest
+        # to any cell, or only to cells that are out of range anyway
+        center_latitude, center_longitude = np.array([latitudes.mean()]), np.array([longitudes.mean()])
+        center_distances = get_pairwise_distances(center_latitude, center_longitude, index, all_positions)[0]
+        block_radius = float(get_pairwise_distances(center_latitude, center_longitude, cells_index, slice(None)).max())
+        reach = limits[-1] + block_radius + 2 * half_diagonals.max()
+        if len(entries) > 1:
+            reach = min(reach, np.partition(center_distances, 1)[1] + 2 * block_radius)
+        positions = np.flatnonzero(center_distances <= reach)
+        if not len(positions):
+            continue
+
+        distances = get_pairwise_distances(latitudes, longitudes, index, positions)
+        nearest = np.argmin(distances, axis=1)
+        nearest_distances = distances[np.arange(len(cells)), nearest]
+        if len(positions) > 1:
+            second_distances = np.partition(distances, 1, axis=1)[:, 1]
+        else:
+            second_distances = np.full(len(cells), np.inf)
+
+        lower_tiers = np.searchsorted(limits, nearest_distances - half_diagonals, side='right')
+        upper_tiers = np.searchsorted(limits, nearest_distances + half_diagonals, side='right')
+        stable = (
+            (lower_tiers == upper_tiers)
+            & (upper_tiers < len(limits))
+            & (second_distances - nearest_distances > 2 * half_diagonals)
+        )
+
+        for (row, col), position, tier in zip(cells[stable], positions[nearest[stable]], upper_tiers[stable]):
+            zones['cells'][int(row), int(col)] = (int(position), int(tier))
+
+    return zones
+
+
+def find_zone(zones, coordinates):
+    """Return (entry, km, tier) for the nearest pizzeria, tier is None when out of delivery range."""
+    index = zones['index']
+    cell = zones['cells'].get(get_cell(zones, coordinates))
+    if cell is None:
+        entry, distance = find_nearest(index, coordinates)[0]
+        return entry, distance, get_tier(zones['limits'], distance)
+
+    # A single distance, plain floats are several times faster than numpy scalars here
+    position, tier = cell
+    latitude, longitude = (math.radians(float(value)) for value in coordinates)
+    half_dlat = (float(index['latitudes'][position]) - latitude) / 2
+    half_dlon = (float(index['longitudes'][position]) - longitude) / 2
+    a = math.sin(half_dlat) ** 2 + math.cos(latitude) * float(index['cos_latitudes'][position]) * math.sin(half_dlon) ** 2
+    return index['entries'][position], 2 * EARTH_RADIUS * math.asin(math.sqrt(min(a, 1.0))), tier
@@ -1,27 +1,74 @@
+import argparse
+import hashlib
+import json
 import logging
 import os
+import threading
+import time
 import redis
+import requests
 import telegram
+import breaker
+import cache
+import catalog
+import customers
+import dispatch
 import elasticpath
-
+import geoindex
+import metrics
+import ratelimit
+import scheduler
+import sessions
+import webhook
+
+from collections import Counter, deque
 from dotenv import load_dotenv
-from functools import partial
+from functools import partial, wraps
 from telegram.ext import Filters, Updater
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+from telegram.utils.request import Request
 
-from utils import fetch_coordinates, get_distance
+from utils import fetch_coordinates_cached
 
 
 logger = logging.getLogger('telegram_shop')
 
+FILE_ID_TTL = 30 * 24 * 60 * 60
+PIZZERIA_INDEX_TTL = 10 * 60
+PIZZERIA_INDEX_RETRY = 30
+STATS_INTERVAL = 10 * 60
+RETRY_AFTER_ATTEMPTS = 3
+EDIT_IN_PLACE = True
+MENU_PAGE_SIZE = 8
+CART_MIRROR_TTL = 5 * 60
+DELIVERY_REMINDER_DELAY = 60 * 60
+COURIER_ESCALATION_DELAY = 50 * 60
+DELIVERY_TIERS = [(0.5, 0), (5, 100), (20, 300)]
+
+delivery_zones = {'zones': None, 'fingerprint': None, 'checked_at': 0}
+delivery_zones_lock = threading.Lock()
+
+render_stats = Counter()
+stats_lock = threading.Lock()
+
+chat_queues = {}
+chat_queues_lock = threading.Lock()
+
+menu_pages = {'version': None, 'pages': []}
+menu_pages_lock = threading.Lock()
 
-def start(bot, update):
+
+def start(bot, update, session, page=None):
     token = elasticpath_token()
-    products = {product['name']: product['id'] for product in elasticpath.get_products(token)['data']}
-    keyboard = [[InlineKeyboardButton(product_name, callback_data=product_id)] for product_name, product_id in products.items()]
-    keyboard.append([InlineKeyboardButton('🛒 Корзина', callback_data='cart')])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    pages = get_menu_pages(token)
+    if page is None:
+        page = int(session.get('menu_page', 0))
+    page = min(max(page, 0), len(pages) - 1)
+    session['menu_page'] = page
+    reply_markup = pages[page]['reply_markup']
+    prefetch_menu_page(token, pages, page)
+    prefetch_menu_page(token, pages, page + 1)
 
     if update.message:
         update.message.reply_text(
@@ -29,34 +76,36 @@ def start(bot, update):
             reply_markup=reply_markup
         )
     else:
-        chat_id = update.callback_query.message.chat_id
-        message_id = update.callback_query.message.message_id
-        bot.send_message(
-            chat_id=chat_id,
+        message = update.callback_query.message
+        render(
+            bot,
+            message.chat_id,
+            session,
+            message,
             reply_markup=reply_markup,
             text='Выбирайте, пожалуйста:'
         )
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
 
     return 'HANDLE_MENU'
 
 
-def handle_menu(bot, update):
+def handle_menu(bot, update, session):
     query = update.callback_query
     chat_id = query.message.chat_id
-    message_id = query.message.message_id
 
     token = elasticpath_token()
 
     if query.data == 'cart':
-        send_cart_keyboard(bot, chat_id)
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
+        send_cart_keyboard(bot, chat_id, session, query.message)
         return 'HANDLE_CART'
 
+    if query.data.startswith('page/'):
+        return start(bot, update, session, page=int(query.data.split('/')[1]))
+
     product_id = query.data
-    product = elasticpath.get_products(token, product_id)
+    product = catalog.get_product(db, token, product_id)
     product_image_id = product['data']['relationships']['main_image']['data']['id']
-    product_image_url = elasticpath.get_image_url(token, product_image_id)
+    product_image_url = catalog.get_image_url(db, token, product_image_id)
 
     caption = elasticpath.get_product_markdown_output(product)
 
@@ -66,65 +115,70 @@ def handle_menu(bot, update):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    bot.send_photo(
-        chat_id=chat_id,
-        photo=product_image_url,
+    send_product_photo(
+        bot,
+        chat_id,
+        product_id,
+        product_image_id,
+        product_image_url,
+        session=session,
+        message=query.message,
         caption=caption,
         parse_mode=telegram.ParseMode.MARKDOWN,
         reply_markup=reply_markup
     )
 
-    bot.delete_message(chat_id=chat_id, message_id=message_id)
-
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_description(bot, update):
+def handle_description(bot, update, session):
     query = update.callback_query
     chat_id = query.message.chat_id
 
     action = query.data.split('/')
 
     if action[0] == 'back':
-        return start(bot, update)
+        return start(bot, update, session)
 
     elif action[0] == 'buy':
         product_id = action[1]
         token = elasticpath_token()
-        elasticpath.add_product_to_cart(token, chat_id, product_id)
+        cart_response = elasticpath.add_product_to_cart(token, chat_id, product_id)
+        sessions.set_cart_mirror(session, cart_response, cart_response['data'])
         update.callback_query.answer('Товар добавлен в корзину')
         return 'HANDLE_DESCRIPTION'
 
 
-def handle_cart(bot, update):
+def handle_cart(bot, update, session):
     query = update.callback_query
     chat_id = query.message.chat_id
-    message_id = query.message.message_id
 
 
     if query.data == 'menu':
-        return start(bot, update)
+        return start(bot, update, session)
 
     elif query.data == 'pay':
-        bot.send_message(
-            chat_id=chat_id,
+        render(
+            bot,
+            chat_id,
+            session,
+            query.message,
             text='Пришлите нам ваш адрес текстом или геолокацию.'
         )
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
         return 'HANDLE_WAITING_LOCATION'
 
     product_id = query.data
     token = elasticpath_token()
-    elasticpath.remove_cart_item(token, chat_id, product_id)
+    cart_response = elasticpath.remove_cart_item(token, chat_id, product_id)
+    sessions.set_cart_mirror(session, cart_response, cart_response['data'])
 
-    send_cart_keyboard(bot, chat_id)
-    bot.delete_message(chat_id=chat_id, message_id=message_id)
+    send_cart_keyboard(bot, chat_id, session, query.message)
     return 'HANDLE_CART'
 
 
-def handle_waiting_location(bot, update):
+def handle_waiting_location(bot, update, session):
     if update.callback_query and update.callback_query.data == 'menu':
-        return start(bot, update)
+        return start(bot, update, session)
 
     message = update.edited_message or update.message
     chat_id = message.chat_id
@@ -134,21 +188,26 @@ def handle_waiting_location(bot, update):
         longitude = message.location.longitude
     else:
         try:
-            latitude, longitude = fetch_coordinates(YANDEX_GEOCODER_KEY, message.text)
+            latitude, longitude = fetch_coordinates_cached(db, YANDEX_GEOCODER_KEY, message.text)
         except IndexError:
             bot.send_message(
                 chat_id = chat_id,
                 text=f'Кажется, вы ошиблись в адресе, повторите пожалуйста:'
             )
             return 'HANDLE_WAITING_LOCATION'
+        except (breaker.CircuitOpenError, requests.RequestException) as error:
+            logger.warning(f'Geocoder unavailable: {error}')
+            location_button = [[KeyboardButton('📍 Отправить геолокацию', request_location=True)]]
+            bot.send_message(
+                chat_id = chat_id,
+                text=f'Не получается найти адрес, пришлите, пожалуйста, вашу геолокацию:',
+                reply_markup=ReplyKeyboardMarkup(location_button, resize_keyboard=True, one_time_keyboard=True)
+            )
+            return 'HANDLE_WAITING_LOCATION'
 
-    token = elasticpath_token()
-    entries = elasticpath.get_all_entries(token, 'Pizzeria')
-    for entry in entries:
-        entry['distance'] = get_distance([latitude, longitude], entry['coordinates'])
-
-    entry_with_min_distance = min(entries, key=lambda entry: entry['distance'])
-    min_distance = entry_with_min_distance['distance']
+    zones = get_delivery_zones()
+    with metrics.track_upstream('geoindex', 'find_zone'):
+        entry_with_min_distance, min_distance, tier = geoindex.find_zone(zones, (latitude, longitude))
 
     customer_data = {
         'Name': message.chat.first_name,
@@ -157,38 +216,17 @@ def handle_waiting_location(bot, update):
         'PizzeiaID': entry_with_min_distance["id"]
     }
 
-    create_entry_response = elasticpath.create_entry(token, 'Customer', customer_data)
-    customer_entry_id = create_entry_response['data']['id']
+    customer_entry_id = customers.save_customer(db, customer_data)
+    session.update(
+        customer_id=customer_entry_id,
+        latitude=latitude,
+        longitude=longitude,
+        pizzeria_id=entry_with_min_distance['id'],
+    )
 
     keyboard = [[InlineKeyboardButton(f'◀️ В меню', callback_data='menu')]]
 
-    if min_distance < 0.5:
-        text = f'Может, заберете пиццу из нашей пиццерии неподалеку? Она всего в *{int(min_distance*1000)}* метрах от вас, вот ее адрес: *{entry_with_min_distance["Address"]}*. Или доставим сами бесплатно, нам не сложно)'
-        keyboard.insert(0,
-            [
-                InlineKeyboardButton(f'Доставка', callback_data=f'delivery/{customer_entry_id}/'),
-                InlineKeyboardButton(f'Самовывоз', callback_data=f'self-delivery/{customer_entry_id}')
-            ]
-        )
-    elif min_distance < 5:
-        delivery_price = 100
-        text = f'Доставка будет стоить *{delivery_price} ₽.*\nДоставляем или самовывоз?'
-        keyboard.insert(0,
-            [
-                InlineKeyboardButton(f'Доставка +{delivery_price} ₽', callback_data=f'delivery/{customer_entry_id}/{delivery_price}'),
-                InlineKeyboardButton(f'Самовывоз', callback_data=f'self-delivery/{customer_entry_id}')
-            ]
-        )
-    elif min_distance < 20:
-        delivery_price = 300
-        text = f'Доставка будет стоить *{delivery_price} ₽.*\nДоставляем или самовывоз?'
-        keyboard.insert(0,
-            [
-                InlineKeyboardButton(f'Доставка +{delivery_price} ₽', callback_data=f'delivery/{customer_entry_id}/{delivery_price}'),
-                InlineKeyboardButton(f'Самовывоз', callback_data=f'self-delivery/{customer_entry_id}')
-            ]
-        )
-    else:
+    if tier is None:
         text = f'Простите, но так далеко мы пиццу не доставим. Ближайшая пиццерия аж в *{min_distance:.1f} км* от вас.\nПопробуете ввести другой адрес?'
         bot.send_message(
             chat_id = chat_id,
@@ -198,6 +236,16 @@ def handle_waiting_location(bot, update):
         )
         return 'HANDLE_WAITING_LOCATION'
 
+    _, delivery_price = DELIVERY_TIERS[tier]
+    if not delivery_price:
+        text = f'Может, заберете пиццу из нашей пиццерии неподалеку? Она всего в *{int(min_distance*1000)}* метрах от вас, вот ее адрес: *{entry_with_min_distance["Address"]}*. Или доставим сами бесплатно, нам не сложно)'
+        delivery_button = InlineKeyboardButton(f'Доставка', callback_data=f'delivery/{customer_entry_id}/')
+    else:
+        text = f'Доставка будет стоить *{delivery_price} ₽.*\nДоставляем или самовывоз?'
+        delivery_button = InlineKeyboardButton(
+            f'Доставка +{delivery_price} ₽', callback_data=f'delivery/{customer_entry_id}/{delivery_price}')
+    keyboard.insert(0, [delivery_button, InlineKeyboardButton(f'Самовывоз', callback_data=f'self-delivery/{customer_entry_id}')])
+
     bot.send_message(
         chat_id = chat_id,
         text=text,
@@ -207,80 +255,176 @@ def handle_waiting_location(bot, update):
     return 'HANDLE_DELIVERY'
 
 
-def handle_delivery(bot, update):
+def handle_delivery(bot, update, session):
     query = update.callback_query
     chat_id = query.message.chat_id
-    message_id = query.message.message_id
 
     action = query.data.split('/')
 
     if action[0] == 'menu':
-        return start(bot, update)
+        return start(bot, update, session)
 
-    token = elasticpath_token()
     customer_entry_id = action[1]
-    customer_entry = elasticpath.get_entry(token, 'Customer', customer_entry_id)
-    pizzeria_entry_id = customer_entry['PizzeiaID']
-    pizzeria_entry = elasticpath.get_entry(token, 'Pizzeria', pizzeria_entry_id)
+    if session.get('customer_id') == customer_entry_id:
+        customer_entry = {
+            'Latitude': session['latitude'],
+            'Longitude': session['longitude'],
+            'PizzeiaID': session['pizzeria_id'],
+        }
+    else:
+        customer_entry = customers.get_customer(db, customer_entry_id)
+        if not customer_entry:
+            customer_entry = elasticpath.get_entry(elasticpath_token(), 'Customer', customer_entry_id)
+    pizzeria_entry = get_pizzeria(customer_entry['PizzeiaID'])
 
     menu_button = [[InlineKeyboardButton('◀️ Меню', callback_data='menu')]]
 
     if action[0] == 'self-delivery':
         text = f'Адрес пиццерии:\n*{pizzeria_entry["Address"]}.*\n\n🍕 Ждем вас)'
-        bot.send_message(
-            chat_id=chat_id,
+        render(
+            bot,
+            chat_id,
+            session,
+            query.message,
             text=text,
             reply_markup=InlineKeyboardMarkup(menu_button),
             parse_mode=telegram.ParseMode.MARKDOWN
         )
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
 
     elif action[0] == 'delivery':
         text = f'Ваша пицца уже в пути! 🚀'
-        job_queue.run_once(check_delivey_time, 3600, context=chat_id)
-        bot.send_message(
-            chat_id=chat_id,
+        render(
+            bot,
+            chat_id,
+            session,
+            query.message,
             text=text,
             reply_markup=InlineKeyboardMarkup(menu_button),
             parse_mode=telegram.ParseMode.MARKDOWN
         )
-        bot.delete_message(chat_id=chat_id, message_id=message_id)
 
         deliver_chat_id = pizzeria_entry["DeliverTelegramID"]
+        cart, cart_items = get_cart(session, chat_id)
+        order_id = dispatch.enqueue_order(db, {
+            'chat_id': chat_id,
+            'courier_chat_id': deliver_chat_id,
+            'cart': cart,
+            'cart_items': cart_items,
+            'latitude': customer_entry['Latitude'],
+            'longitude': customer_entry['Longitude'],
+            'delivery_price': action[2],
+        })
+        scheduler.schedule(db, 'delivery_reminder', DELIVERY_REMINDER_DELAY, chat_id=chat_id)
+        scheduler.schedule(
+            db, 'courier_escalation', COURIER_ESCALATION_DELAY, chat_id=deliver_chat_id, order_id=order_id)
 
-        cart = elasticpath.get_a_cart(token, chat_id)
-        cart_items = elasticpath.get_cart_items(token, chat_id)
-        cart_items_formatted = elasticpath.get_formatted_cart_items_without_description(cart, cart_items)
-
-        delivery_text = f'*Новый заказ!*\n\n' + cart_items_formatted
-        delivery_price = action[2]
-        if delivery_price:
-            delivery_text += f' + доставка *{delivery_price} ₽*'
-
-        bot.send_message(
-            chat_id=deliver_chat_id,
-            text=delivery_text,
-            parse_mode=telegram.ParseMode.MARKDOWN
-        )
-
-        bot.send_location(
-            chat_id=deliver_chat_id,
-            latitude=customer_entry['Latitude'],
-            longitude=customer_entry['Longitude']
-        )
-    
     return 'HANDLE_FINISH'
 
 
-def handle_finish(bot, update):
+def handle_finish(bot, update, session):
     query = update.callback_query
     if query.data == 'menu':
-        return start(bot, update)
+        return start(bot, update, session)
+
+
+def send_order_text(bot, order):
+    cart_items_formatted = elasticpath.get_formatted_cart_items_without_description(order['cart'], order['cart_items'])
+
+    delivery_text = f'*Новый заказ №{order["id"]}!*\n\n' + cart_items_formatted
+    if order['delivery_price']:
+        delivery_text += f' + доставка *{order["delivery_price"]} ₽*'
+
+    bot.send_message(
+        chat_id=order['courier_chat_id'],
+        text=delivery_text,
+        parse_mode=telegram.ParseMode.MARKDOWN
+    )
 
 
-def check_delivey_time(bot, job):
+def send_order_location(bot, order):
+    bot.send_location(
+        chat_id=order['courier_chat_id'],
+        latitude=order['latitude'],
+        longitude=order['longitude']
+    )
+
+
+ORDER_STEPS = [
+    ('text', send_order_text),
+    ('location', send_order_location),
+]
+
+
+def check_delivey_time(bot, context):
     text = 'Если курьер опаздывает - забирайте пиццу *бесплатно!*'
-    bot.send_message(chat_id=job.context, text=text, parse_mode=telegram.ParseMode.MARKDOWN)
+    bot.send_message(chat_id=context['chat_id'], text=text, parse_mode=telegram.ParseMode.MARKDOWN)
+
+
+def escalate_delivery(bot, context):
+    if not dispatch.is_dispatched(db, context['order_id']):
+        logger.warning(f'Order {context["order_id"]} never reached the courier, not escalating')
+        return
+
+    minutes_left = (DELIVERY_REMINDER_DELAY - COURIER_ESCALATION_DELAY) // 60
+    text = f'⏰ До конца времени доставки заказа №{context["order_id"]} осталось *{minutes_left} минут*'
+    bot.send_message(chat_id=context['chat_id'], text=text, parse_mode=telegram.ParseMode.MARKDOWN)
+
+
+SCHEDULED_JOBS = {
+    'delivery_reminder': check_delivey_time,
+    'courier_escalation': escalate_delivery,
+}
+
+
+def enqueue_update(bot, update):
+    """Polling mode entry point: run updates of one chat in arrival order, different chats in parallel.
+
+    Runs in the dispatcher thread, which takes updates in order; each chat's queue
+    is drained by a single pool thread at a time. Repeated button taps are dropped
+    here, before they wait in the queue.
+    """
+    chat = update.effective_chat
+    if not chat:
+        return
+
+    if update.callback_query and is_duplicate_callback(update.callback_query):
+        dispatcher.run_async(update.callback_query.answer)
+        return
+
+    with chat_queues_lock:
+        queue = chat_queues.get(chat.id)
+        if queue is not None:
+            queue.append(update)
+            return
+        chat_queues[chat.id] = deque([update])
+
+    dispatcher.run_async(drain_chat_queue, bot, chat.id)
+
+
+def is_duplicate_callback(query):
+    message = query.message
+    edit_date = int(message.edit_date.timestamp()) if message.edit_date else 0
+    try:
+        return sessions.is_duplicate_callback(
+            db, message.chat_id, message.message_id, edit_date, message.text or message.caption, query.data)
+    except redis.exceptions.RedisError as error:
+        logger.error(error)
+        return False
+
+
+def drain_chat_queue(bot, chat_id):
+    while True:
+        with chat_queues_lock:
+            queue = chat_queues[chat_id]
+            if not queue:
+                del chat_queues[chat_id]
+                return
+            update = queue.popleft()
+
+        try:
+            handle_users_reply(bot, update)
+        except Exception as error:
+            logger.error(f'Update failed for chat {chat_id}: {error}')
 
 
 def handle_users_reply(bot, update):
@@ -293,15 +437,21 @@ def handle_users_reply(bot, update):
     else:
         return
 
+    try:
+        session = sessions.load_session(db, chat_id)
+    except redis.exceptions.RedisError as error:
+        logger.error(error)
+        return
+
+    loaded_session = dict(session)
+
     if user_reply == '/start':
         user_state = 'START'
+    elif update.message and update.message.location:
+        user_state = 'HANDLE_WAITING_LOCATION'
     else:
-        try:
-            user_state = db.get(chat_id)
-        except redis.exceptions.RedisError as error:
-            logger.error(error)
+        user_state = session.get('state', 'START')
 
-    
     states_functions = {
         'START': start,
         'HANDLE_MENU': handle_menu,
@@ -312,23 +462,145 @@ def handle_users_reply(bot, update):
         'HANDLE_FINISH': handle_finish,
     }
     state_handler = states_functions[user_state]
+    started_at = time.perf_counter()
     try:
-        next_state = state_handler(bot, update)
-        db.set(chat_id, next_state)
+        next_state = state_handler(bot, update, session)
+        if next_state:
+            session['state'] = next_state
+        sessions.save_session(db, chat_id, session, loaded_session)
     except Exception as error:
+        metrics.errors.labels(state_handler.__name__, type(error).__name__).inc()
         logger.error(error)
+    else:
+        transition = f'{user_state}->{next_state or user_state}'
+        metrics.handler_latency.labels(state_handler.__name__, transition).observe(time.perf_counter() - started_at)
 
 
-def send_cart_keyboard(bot, chat_id):
-    token = elasticpath_token()
-    cart = elasticpath.get_a_cart(token, chat_id)
-    cart_items = elasticpath.get_cart_items(token, chat_id)
+def build_menu_pages(products):
+    chunks = [products[i:i + MENU_PAGE_SIZE] for i in range(0, len(products), MENU_PAGE_SIZE)] or [[]]
+    pages = []
+    for number, chunk in enumerate(chunks):
+        keyboard = [[InlineKeyboardButton(product['name'], callback_data=product['id'])] for product in chunk]
+
+        navigation = []
+        if number > 0:
+            navigation.append(InlineKeyboardButton('⬅️', callback_data=f'page/{number - 1}'))
+        if number < len(chunks) - 1:
+            navigation.append(InlineKeyboardButton('➡️', callback_data=f'page/{number + 1}'))
+        if navigation:
+            keyboard.append(navigation)
+
+        keyboard.append([InlineKeyboardButton('🛒 Корзина', callback_data='cart')])
+        pages.append({'products': chunk, 'reply_markup': InlineKeyboardMarkup(keyboard).to_json()})
+
+    return pages
+
+
+def get_menu_pages(token):
+    menu = catalog.get_menu(db, token)
+    if menu['version'] != menu_pages['version']:
+        with menu_pages_lock:
+            if menu['version'] != menu_pages['version']:
+                menu_pages['pages'] = build_menu_pages(menu['products'])
+                menu_pages['version'] = menu['version']
+
+    return menu_pages['pages']
+
+
+def prefetch_menu_page(token, pages, page):
+    if page >= len(pages):
+        return
+
+    for product in pages[page]['products']:
+        main_image = product.get('relationships', {}).get('main_image')
+        if main_image:
+            elasticpath.executor.submit(catalog.get_image_url, db, token, main_image['data']['id'])
+
+
+def refresh_delivery_zones():
+    """Rebuild the zone map if the Pizzeria flow has changed and swap it in.
+
+    A failed check keeps the previous map and is retried after PIZZERIA_INDEX_RETRY
+    seconds, it raises only when there is no map to fall back on.
+    """
+    if not delivery_zones_lock.acquire(blocking=delivery_zones['zones'] is None):
+        return
+
+    try:
+        if delivery_zones['zones'] is not None and time.monotonic() - delivery_zones['checked_at'] < PIZZERIA_INDEX_TTL:
+            return
+
+        try:
+            entries = elasticpath.get_all_entries(elasticpath_token(), 'Pizzeria')
+            fingerprint = hashlib.sha1(json.dumps(entries, sort_keys=True).encode()).hexdigest()
+            if fingerprint != delivery_zones['fingerprint']:
+                zones = geoindex.build_zones(geoindex.build_index(entries), DELIVERY_TIERS)
+                delivery_zones['zones'] = zones
+                delivery_zones['fingerprint'] = fingerprint
+                logger.info(f'Delivery zones rebuilt: {len(entries)} pizzerias, {len(zones["cells"])} cells')
+        except Exception as error:
+            if delivery_zones['zones'] is None:
+                raise
+            logger.error(f'Delivery zones refresh failed, keeping the previous map: {error}')
+            delivery_zones['checked_at'] = time.monotonic() - PIZZERIA_INDEX_TTL + PIZZERIA_INDEX_RETRY
+        else:
+            delivery_zones['checked_at'] = time.monotonic()
+    finally:
+        delivery_zones_lock.release()
+
+
+def get_delivery_zones():
+    """Zone map of the Pizzeria flow, rebuilt only when the pizzerias have changed.
+
+    Only the first map is built inline, later ones are built in the background
+    while customers keep being quoted from the previous one.
+    """
+    zones = delivery_zones['zones']
+    if zones is None:
+        refresh_delivery_zones()
+        return delivery_zones['zones']
+
+    if time.monotonic() - delivery_zones['checked_at'] >= PIZZERIA_INDEX_TTL and not delivery_zones_lock.locked():
+        threading.Thread(target=refresh_delivery_zones, daemon=True).start()
+    return zones
+
+
+def warm_up_delivery_zones():
+    try:
+        get_delivery_zones()
+    except Exception as error:
+        logger.error(f'Delivery zones not built at startup: {error}')
+
+
+def get_pizzeria(pizzeria_id):
+    for entry in get_delivery_zones()['index']['entries']:
+        if entry['id'] == pizzeria_id:
+            return entry
+
+    return elasticpath.get_entry(elasticpath_token(), 'Pizzeria', pizzeria_id)
+
+
+def get_cart(session, chat_id):
+    mirror = sessions.get_cart_mirror(session, CART_MIRROR_TTL)
+    if mirror:
+        return mirror
+
+    cart, cart_items = elasticpath.get_cart_with_items(elasticpath_token(), chat_id)
+    sessions.set_cart_mirror(session, cart, cart_items)
+    return cart, cart_items
+
+
+def send_cart_keyboard(bot, chat_id, session, message=None):
+    cart, cart_items = get_cart(session, chat_id)
     menu_button = [[InlineKeyboardButton('◀️ Меню', callback_data='menu')]]
     pay_button = [[InlineKeyboardButton('🤑 Оплатить', callback_data='pay')]]
 
     if not cart_items:
-        bot.send_message(
-            chat_id=chat_id,
+        render(
+            bot,
+            chat_id,
+            session,
+            message,
             text='В корзине ничего нет :(',
             reply_markup=InlineKeyboardMarkup(menu_button),
         )
@@ -341,14 +613,143 @@ def send_cart_keyboard(bot, chat_id):
     ] + pay_button + menu_button
 
     reply_markup = InlineKeyboardMarkup(keyboard)
-    bot.send_message(
-        chat_id=chat_id,
+    render(
+        bot,
+        chat_id,
+        session,
+        message,
         text=cart_items_formatted,
         reply_markup=reply_markup,
         parse_mode=telegram.ParseMode.MARKDOWN
     )
 
 
+def render(bot, chat_id, session=None, message=None, text=None, photo=None, **kwargs):
+    """Show a text or photo message in place of `message`.
+
+    The old message is edited when it has the same type, otherwise a new
+    message is sent and the old one deleted.
+    """
+    if EDIT_IN_PLACE and message:
+        try:
+            if text is not None and message.text is not None:
+                edited = bot.edit_message_text(
+                    text=text, chat_id=chat_id, message_id=message.message_id, **kwargs)
+            elif photo is not None and message.photo:
+                media = telegram.InputMediaPhoto(
+                    photo, caption=kwargs.get('caption'), parse_mode=kwargs.get('parse_mode'))
+                edit_kwargs = {key: value for key, value in kwargs.items() if key not in ('caption', 'parse_mode')}
+                edited = bot.edit_message_media(
+                    chat_id=chat_id, message_id=message.message_id, media=media, **edit_kwargs)
+            else:
+                edited = None
+        except telegram.error.BadRequest as error:
+            if 'not modified' in str(error):
+                edited = message
+            else:
+                logger.warning(f'Falling back to a new message: {error}')
+                edited = None
+
+        if edited:
+            count_stat(render_stats, 'api_calls_saved')
+            if session is not None:
+                session['api_calls_saved'] = int(session.get('api_calls_saved', 0)) + 1
+            return edited
+
+    if photo is not None:
+        sent = bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+    else:
+        sent = bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+    if message:
+        bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+    return sent
+
+
+def send_product_photo(bot, chat_id, product_id, image_id, image_url, session=None, message=None, **kwargs):
+    file_id_key = f'telegram_file_id:{product_id}'
+    cached_photo = db.hgetall(file_id_key)
+
+    if cached_photo.get('image_id') == image_id:
+        try:
+            return render(bot, chat_id, session, message, photo=cached_photo['file_id'], **kwargs)
+        except telegram.error.BadRequest as error:
+            logger.warning(f'Cached photo of {product_id} rejected: {error}')
+
+    message = render(bot, chat_id, session, message, photo=image_url, **kwargs)
+    db.hset(file_id_key, mapping={'image_id': image_id, 'file_id': message.photo[-1].file_id})
+    db.expire(file_id_key, FILE_ID_TTL)
+    return message
+
+
+def warm_up_product_photos(bot, chat_id):
+    token = elasticpath_token()
+    for product in catalog.get_products(db, token):
+        main_image = product.get('relationships', {}).get('main_image')
+        if not main_image:
+            continue
+
+        product_id = product['id']
+        image_id = main_image['data']['id']
+        if db.hget(f'telegram_file_id:{product_id}', 'image_id') == image_id:
+            continue
+
+        image_url = catalog.get_image_url(db, token, image_id)
+        try:
+            message = send_product_photo(bot, chat_id, product_id, image_id, image_url, disable_notification=True)
+            bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        except telegram.error.TelegramError as error:
+            logger.error(error)
+
+
+def count_stat(stats, stat, value=1):
+    with stats_lock:
+        stats[stat] += value
+
+
+def get_stats(stats):
+    with stats_lock:
+        return dict(stats)
+
+
+def log_stats(bot, job):
+    logger.info(f'Cache stats: {cache.get_stats()}')
+    logger.info(f'Rate limit stats: {ratelimit.get_stats()}')
+    logger.info(f'Render stats: {get_stats(render_stats)}')
+
+
+def paced(method):
+    """Queue a Bot API call behind the global and per-chat buckets, wait out flood control."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        chat_id = kwargs.get('chat_id', args[0] if args else None)
+        keys = ['telegram', f'telegram_chat:{chat_id}'] if chat_id else ['telegram']
+
+        for attempt in range(RETRY_AFTER_ATTEMPTS):
+            ratelimit.acquire(*keys)
+            try:
+                with metrics.track_upstream('telegram', method.__name__):
+                    return method(self, *args, **kwargs)
+            except telegram.error.RetryAfter as error:
+                logger.warning(f'Flood control for {chat_id}, retrying in {error.retry_after}s')
+                time.sleep(error.retry_after)
+
+        ratelimit.acquire(*keys)
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class RateLimitedBot(telegram.Bot):
+    send_message = paced(telegram.Bot.send_message)
+    send_photo = paced(telegram.Bot.send_photo)
+    send_location = paced(telegram.Bot.send_location)
+    edit_message_text = paced(telegram.Bot.edit_message_text)
+    edit_message_media = paced(telegram.Bot.edit_message_media)
+    edit_message_reply_markup = paced(telegram.Bot.edit_message_reply_markup)
+    delete_message = paced(telegram.Bot.delete_message)
+
+
 def get_database_connection():
     db = redis.Redis(
         host=REDIS_HOST,
@@ -360,8 +761,19 @@ def get_database_connection():
     return db
 
 
+def create_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--webhook', action='store_true', help='Accept updates over a webhook and queue them')
+    parser.add_argument('--worker', type=int, help='Handle queued webhook updates as worker N')
+    parser.add_argument('--dispatcher', action='store_true', help='Only dispatch queued orders to couriers')
+    parser.add_argument(
+        '--workers', type=int, default=int(os.getenv('WEBHOOK_WORKERS', 1)), help='Number of webhook workers')
+    return parser
+
+
 if __name__ == '__main__':
     load_dotenv()
+    args = create_arg_parser().parse_args()
 
     CLIENT_ID = os.getenv('CLIENT_ID')
     CLIENT_SECRET = os.getenv('CLIENT_SECRET')
@@ -370,16 +782,70 @@ if __name__ == '__main__':
     REDIS_PORT = os.getenv('REDIS_PORT')
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
     YANDEX_GEOCODER_KEY = os.getenv('YANDEX_GEOCODER_KEY')
+    TELEGRAM_WORKERS = int(os.getenv('TELEGRAM_WORKERS', 32))
+    TELEGRAM_WARMUP_CHAT_ID = os.getenv('TELEGRAM_WARMUP_CHAT_ID')
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+    WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+    EDIT_IN_PLACE = os.getenv('TELEGRAM_EDIT_IN_PLACE', 'true').lower() in ('1', 'true', 'yes')
+    METRICS_PORT = os.getenv('METRICS_PORT')
+    DISPATCH_CONSUMERS = int(os.getenv('DISPATCH_CONSUMERS', 1))
+    if os.getenv('DELIVERY_TIERS'):
+        DELIVERY_TIERS = sorted(tuple(tier) for tier in json.loads(os.getenv('DELIVERY_TIERS')))
 
     db = get_database_connection()
     elasticpath_token = partial(elasticpath.get_oauth_access_token, db, CLIENT_ID, CLIENT_SECRET)
 
-    updater = Updater(TELEGRAM_TOKEN)
-    job_queue = updater.job_queue
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
-    dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply))
-    dispatcher.add_handler(MessageHandler(Filters.location, handle_waiting_location))
-    dispatcher.add_handler(CommandHandler('start', handle_users_reply))
-    updater.start_polling()
-    updater.idle()
+    bot = RateLimitedBot(
+        TELEGRAM_TOKEN,
+        base_url=os.getenv('TELEGRAM_API_URL'),
+        request=Request(con_pool_size=TELEGRAM_WORKERS + 4)
+    )
+
+    if METRICS_PORT:
+        metrics.register_stats('pizzabot_cache', 'Cache lookups by namespace', cache.get_stats)
+        metrics.register_stats('pizzabot_rate_limit', 'Outbound call pacing', ratelimit.get_stats)
+        metrics.register_stats('pizzabot_updates', 'Duplicate button taps dropped', sessions.get_stats)
+        metrics.register_stats('pizzabot_circuit_breaker', 'Upstream circuit state (0 closed, 1 half open, 2 open)', breaker.get_stats)
+        metrics.register_stats('pizzabot_dispatch', 'Orders queued for couriers', dispatch.get_stats)
+        metrics.register_stats('pizzabot_customers', 'Customer entries written behind', customers.get_stats)
+        metrics.register_stats('pizzabot_render', 'Bot API calls saved by editing', lambda: {
+            f'render:{stat}': value for stat, value in get_stats(render_stats).items()})
+        metrics.start_exporter(int(METRICS_PORT) + (args.worker + 1 if args.worker is not None else 0))
+
+    if args.webhook:
+        if WEBHOOK_URL:
+            webhook_options = {'secret_token': WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+            bot.set_webhook(url=WEBHOOK_URL, **webhook_options)
+        webhook.run_webhook(db, WEBHOOK_HOST, WEBHOOK_PORT, args.workers, WEBHOOK_SECRET)
+
+    elif args.dispatcher:
+        dispatch.run_dispatcher(db, dispatch.get_consumer_name(), ORDER_STEPS, bot)
+
+    elif args.worker is not None:
+        ratelimit.split_limits(args.workers)
+        threading.Thread(target=warm_up_delivery_zones, daemon=True).start()
+        scheduler.start_scheduler(db, SCHEDULED_JOBS, bot)
+        dispatch.start_dispatchers(db, DISPATCH_CONSUMERS, ORDER_STEPS, bot)
+        customers.start_flusher(db, elasticpath_token)
+        webhook.run_worker(db, bot, args.worker, args.workers, handle_users_reply)
+
+    else:
+        updater = Updater(bot=bot, workers=TELEGRAM_WORKERS)
+        threading.Thread(target=warm_up_delivery_zones, daemon=True).start()
+        scheduler.start_scheduler(db, SCHEDULED_JOBS, bot)
+        dispatch.start_dispatchers(db, DISPATCH_CONSUMERS, ORDER_STEPS, bot)
+        customers.start_flusher(db, elasticpath_token)
+        job_queue = updater.job_queue
+        dispatcher = updater.dispatcher
+        dispatcher.add_handler(CallbackQueryHandler(enqueue_update))
+        dispatcher.add_handler(MessageHandler(Filters.text, enqueue_update))
+        dispatcher.add_handler(MessageHandler(Filters.location, enqueue_update))
+        dispatcher.add_handler(CommandHandler('start', enqueue_update))
+        if TELEGRAM_WARMUP_CHAT_ID:
+            job_queue.run_once(lambda bot, job: warm_up_product_photos(bot, TELEGRAM_WARMUP_CHAT_ID), 0)
+
+        job_queue.run_repeating(log_stats, STATS_INTERVAL)
+        updater.start_polling()
+        updater.idle()
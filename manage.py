@@ -1,13 +1,25 @@
 import argparse
+import hashlib
 import json
 import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 import redis
 import requests
 from dotenv import load_dotenv
 from tqdm import tqdm
 
+import breaker
+import catalog
 import elasticpath
+import utils
+
+
+IMPORT_WORKERS = 8
+IMAGE_HASH_LENGTH = 16
 
 
 def get_json(path):
@@ -17,29 +29,158 @@ def get_json(path):
     return json_data
 
 
-def create_menu(token, path):
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return {}
+
+    return get_json(path)
+
+
+def save_checkpoint(path, checkpoint):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_path, path)
+
+
+def upload_image(token, img_url):
+    img_name = img_url.split('/')[-1]
+    response = elasticpath.session.get(img_url, timeout=elasticpath.TIMEOUT)
+    response.raise_for_status()
+    return elasticpath.create_file(token, response.content, img_name)
+
+
+def import_menu_item(token, item, checkpoint, update_checkpoint):
+    sku = str(item['id'])
+    progress = checkpoint.get(sku, {})
+
+    if 'image_id' not in progress:
+        create_file_response = upload_image(token, item['product_image']['url'])
+        progress = update_checkpoint(sku, image_id=create_file_response['data']['id'])
+
+    if 'product_id' not in progress:
+        create_product_response = elasticpath.create_product(
+            token, item['id'], item['name'], item['description'], item['price'])
+        progress = update_checkpoint(sku, product_id=create_product_response['data']['id'])
+
+    if not progress.get('linked'):
+        elasticpath.create_main_image_relationship(token, progress['product_id'], progress['image_id'])
+        update_checkpoint(sku, linked=True)
+
+
+def create_menu(token, path, checkpoint_path=None, workers=IMPORT_WORKERS):
     print('- Create menu')
     menu = get_json(path)
+    checkpoint_path = checkpoint_path or f'{path}.checkpoint'
+    checkpoint = load_checkpoint(checkpoint_path)
+    checkpoint_lock = threading.Lock()
+
+    def update_checkpoint(sku, **values):
+        with checkpoint_lock:
+            progress = {**checkpoint.get(sku, {}), **values}
+            checkpoint[sku] = progress
+            save_checkpoint(checkpoint_path, checkpoint)
+            return progress
+
+    pending = [item for item in menu if not checkpoint.get(str(item['id']), {}).get('linked')]
+    if len(pending) < len(menu):
+        print(f'- Resuming from {checkpoint_path}: {len(menu) - len(pending)} items already imported')
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(import_menu_item, token, item, checkpoint, update_checkpoint) for item in pending]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                future.result()
+            except (requests.exceptions.RequestException, breaker.CircuitOpenError) as error:
+                failed += 1
+                print(error)
+
+    if failed:
+        print(f'- {failed} items failed, run again to resume')
+    elif os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def get_image_file_name(content, img_url):
+    content_hash = hashlib.sha1(content).hexdigest()[:IMAGE_HASH_LENGTH]
+    return content_hash, f'{content_hash}-{img_url.split("/")[-1]}'
+
+
+def sync_menu_item(token, item, product, files, files_lock):
+    """Bring one Moltin product in line with its menu item, return what was done."""
+    response = elasticpath.session.get(item['product_image']['url'], timeout=elasticpath.TIMEOUT)
+    response.raise_for_status()
+    content_hash, img_name = get_image_file_name(response.content, item['product_image']['url'])
 
-    for item in tqdm(menu):
-        product_id = item['id']
-        name = item['name']
-        description = item['description']
-        price = item['price']
-        img_url = item['product_image']['url']
-        img_name = img_url.split('/')[-1]
-        img = requests.get(img_url).content
+    # `files` maps a content hash to a file id, or to the Future of an upload in progress,
+    # so that items sharing an image upload it once
+    with files_lock:
+        image = files.get(content_hash)
+        uploading = image is None
+        if uploading:
+            image = files[content_hash] = Future()
 
+    if uploading:
         try:
-            create_file_response = elasticpath.create_file(token, img, img_name)
-            create_product_response = elasticpath.create_product(token, product_id, name, description, price)
+            image.set_result(elasticpath.create_file(token, response.content, img_name)['data']['id'])
+        except Exception as error:
+            with files_lock:
+                del files[content_hash]
+            image.set_exception(error)
+            raise
 
-            image_id = create_file_response['data']['id']
-            product_id = create_product_response['data']['id']
-        
-            elasticpath.create_main_image_relationship(token, product_id, image_id)
-        except requests.exceptions.HTTPError as error:
-            print(error)
+    image_id = image.result() if isinstance(image, Future) else image
+
+    if not product:
+        product_id = elasticpath.create_product(
+            token, item['id'], item['name'], item['description'], item['price'])['data']['id']
+        elasticpath.create_main_image_relationship(token, product_id, image_id)
+        return 'created'
+
+    action = 'unchanged'
+    if (product['name'], product['description'], product['price'][0]['amount']) != \
+            (item['name'], item['description'], item['price']):
+        elasticpath.update_product(token, product['id'], item['name'], item['description'], item['price'])
+        action = 'updated'
+
+    main_image = product.get('relationships', {}).get('main_image')
+    if not main_image or main_image['data']['id'] != image_id:
+        elasticpath.create_main_image_relationship(token, product['id'], image_id)
+        action = 'updated'
+
+    return action
+
+
+def sync_menu(token, path, workers=IMPORT_WORKERS):
+    print('- Sync menu')
+    menu = get_json(path)
+    products = {product['sku']: product for product in elasticpath.iterate_products(token)}
+    files = {}
+    for file in elasticpath.iterate_files(token):
+        content_hash, _, _ = file['file_name'].partition('-')
+        if len(content_hash) == IMAGE_HASH_LENGTH:
+            files[content_hash] = file['id']
+    files_lock = threading.Lock()
+
+    menu_skus = {str(item['id']) for item in menu}
+    stale_products = [product for sku, product in products.items() if sku not in menu_skus]
+
+    results = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(sync_menu_item, token, item, products.get(str(item['id'])), files, files_lock)
+            for item in menu
+        ]
+        futures += [executor.submit(elasticpath.delete_product, token, product['id']) for product in stale_products]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                results[future.result() or 'deleted'] += 1
+            except (requests.exceptions.RequestException, breaker.CircuitOpenError) as error:
+                results['failed'] += 1
+                print(error)
+
+    print('- ' + ', '.join(f'{action}: {count}' for action, count in sorted(results.items())))
 
 
 def create_flows(token, path):
@@ -60,28 +201,69 @@ def create_flows(token, path):
             print('Already exists')
 
 
-def add_addresses(token, path, flow='Pizzeria'):
+def get_address_values(db, geocoder_key, item):
+    values = {
+        'Address': item['address']['full'],
+        'Alias': item['alias'],
+    }
+
+    coordinates = item.get('coordinates') or {}
+    if coordinates.get('lat') and coordinates.get('lon'):
+        latitude, longitude = coordinates['lat'], coordinates['lon']
+    else:
+        latitude, longitude = utils.fetch_coordinates_cached(db, geocoder_key, values['Address'])
+
+    values['Latitude'] = float(latitude)
+    values['Longitude'] = float(longitude)
+    return values
+
+
+def upsert_address(token, flow, entry, values):
+    if not entry:
+        elasticpath.create_entry(token, flow, values)
+        return 'created'
+
+    if all(entry.get(field) == value for field, value in values.items()):
+        return 'unchanged'
+
+    elasticpath.update_entry(token, flow, entry['id'], values)
+    return 'updated'
+
+
+def add_addresses(token, path, flow='Pizzeria', workers=IMPORT_WORKERS, db=None, geocoder_key=None):
     addresses = get_json(path)
     print('\n- Add addresses...')
+    started_at = time.monotonic()
 
-    for item in tqdm(addresses):
-        values = {
-            'Address': item['address']['full'],
-            'Alias': item['alias'],
-            'Latitude': item['coordinates']['lat'],
-            'Longitude': item['coordinates']['lon'],
-        }
+    existing_entries = {entry.get('Alias'): entry for entry in elasticpath.iterate_entries(token, flow)}
 
-        elasticpath.create_entry(token, flow, values)
+    def load_address(item):
+        values = get_address_values(db, geocoder_key, item)
+        return upsert_address(token, flow, existing_entries.get(values['Alias']), values)
 
-    print('- Done.')
+    results = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(load_address, item) for item in addresses]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                results[future.result()] += 1
+            except (requests.exceptions.RequestException, breaker.CircuitOpenError, IndexError) as error:
+                results['failed'] += 1
+                print(error)
+
+    elapsed = time.monotonic() - started_at
+    print('- ' + ', '.join(f'{action}: {count}' for action, count in sorted(results.items())))
+    print(f'- Done in {elapsed:.1f}s, {len(addresses) / elapsed:.1f} addresses/s.')
 
 
 def create_arg_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--create_flows', help='Add pizzeria models (flows)')
-    parser.add_argument('-a', '--add_addresses', help='Add pizzeria addresses')
+    parser.add_argument('-a', '--add_addresses', help='Add or update pizzeria addresses')
     parser.add_argument('-m', '--create_menu', help='CMS product filling')
+    parser.add_argument('-s', '--sync_menu', help='Sync CMS products with a menu file, changing only what differs')
+    parser.add_argument('-c', '--checkpoint', help='Menu import checkpoint file (default: <menu>.checkpoint)')
+    parser.add_argument('-w', '--workers', type=int, default=IMPORT_WORKERS, help='Concurrent import workers')
     return parser
 
 
@@ -94,15 +276,21 @@ if __name__ == "__main__":
     REDIS_HOST = os.getenv('REDIS_HOST')
     REDIS_PORT = os.getenv('REDIS_PORT')
     REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+    YANDEX_GEOCODER_KEY = os.getenv('YANDEX_GEOCODER_KEY')
 
     db = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, decode_responses=True)
     token = elasticpath.get_oauth_access_token(db, CLIENT_ID, CLIENT_SECRET)
 
     if args.create_menu:
-        create_menu(token, args.create_menu)
+        create_menu(token, args.create_menu, args.checkpoint, args.workers)
+        catalog.invalidate(db)
+
+    if args.sync_menu:
+        sync_menu(token, args.sync_menu, args.workers)
+        catalog.invalidate(db)
 
     if args.create_flows:
         create_flows(token, args.create_flows)
 
     if args.add_addresses:
-        add_addresses(token, args.add_addresses)
+        add_addresses(token, args.add_addresses, workers=args.workers, db=db, geocoder_key=YANDEX_GEOCODER_KEY)
@@ -0,0 +1,68 @@
+import re
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client.core import REGISTRY, GaugeMetricFamily
+
+
+handler_latency = Histogram(
+    'pizzabot_handler_seconds', 'State handler latency', ['handler', 'transition'])
+upstream_latency = Histogram(
+    'pizzabot_upstream_seconds', 'Upstream call latency', ['upstream', 'endpoint'])
+errors = Counter(
+    'pizzabot_errors_total', 'Errors by component and exception type', ['component', 'exception'])
+hedged_requests = Counter(
+    'pizzabot_hedged_requests_total', 'Duplicate requests sent for slow reads', ['upstream'])
+
+
+def get_endpoint(method, path):
+    """Collapse ids in a URL path so that endpoints make a bounded label set."""
+    return f'{method} {re.sub(r"/([0-9a-f]{8}-[0-9a-f-]{27}|[0-9]+)(?=/|$)", "/{id}", path)}'
+
+
+@contextmanager
+def track_upstream(upstream, endpoint):
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        errors.labels(upstream, type(error).__name__).inc()
+        raise
+    finally:
+        upstream_latency.labels(upstream, endpoint).observe(time.perf_counter() - started_at)
+
+
+def timed(upstream, endpoint):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_upstream(upstream, endpoint):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StatsCollector:
+    """Expose a `get_stats()` dict of 'group:stat' counters at scrape time, off the hot path."""
+
+    def __init__(self, name, documentation, get_stats):
+        self.name = name
+        self.documentation = documentation
+        self.get_stats = get_stats
+
+    def collect(self):
+        family = GaugeMetricFamily(self.name, self.documentation, labels=['group', 'stat'])
+        for key, value in self.get_stats().items():
+            group, _, stat = key.rpartition(':')
+            family.add_metric([group, stat], value)
+        yield family
+
+
+def register_stats(name, documentation, get_stats):
+    REGISTRY.register(StatsCollector(name, documentation, get_stats))
+
+
+def start_exporter(port, host='127.0.0.1'):
+    start_http_server(port, addr=host)
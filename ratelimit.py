@@ -0,0 +1,100 @@
+import os
+import threading
+import time
+from collections import Counter
+
+
+MAX_BUCKETS = 10000
+
+LIMITS = {
+    'telegram': (float(os.getenv('TELEGRAM_RATE', 30)), 30),
+    'telegram_chat': (float(os.getenv('TELEGRAM_CHAT_RATE', 1)), 3),
+    'moltin': (float(os.getenv('MOLTIN_RATE', 20)), 20),
+}
+# Limits on the whole bot token or Moltin store, as opposed to per chat ones
+SHARED_GROUPS = ('telegram', 'moltin')
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+stats = Counter()
+queue_depth = Counter()
+stats_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return how long to wait before using it.
+
+        Tokens may go negative: each caller reserves the next free slot,
+        so waiting callers are served in order at the bucket's rate.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, 0)
+
+    def is_idle(self):
+        with self.lock:
+            return self.tokens + (time.monotonic() - self.updated_at) * self.rate >= self.capacity
+
+
+def get_bucket(key):
+    with buckets_lock:
+        bucket = buckets.get(key)
+        if bucket:
+            return bucket
+
+        if len(buckets) >= MAX_BUCKETS:
+            for idle_key in [key for key, bucket in buckets.items() if bucket.is_idle()]:
+                del buckets[idle_key]
+
+        rate, capacity = LIMITS[key.split(':', 1)[0]]
+        bucket = buckets[key] = TokenBucket(rate, capacity)
+        return bucket
+
+
+def split_limits(processes):
+    """Keep 1/`processes` of every shared limit, so that all processes together stay within it.
+
+    Per chat limits are kept whole: a chat is handled by a single process.
+    """
+    with buckets_lock:
+        for group in SHARED_GROUPS:
+            rate, capacity = LIMITS[group]
+            LIMITS[group] = (rate / processes, max(capacity / processes, 1))
+        buckets.clear()
+
+
+def acquire(*keys):
+    """Block until every bucket in `keys` lets one more call through."""
+    delay = max(get_bucket(key).reserve() for key in keys)
+    if not delay:
+        return
+
+    groups = {key.split(':', 1)[0] for key in keys}
+    with stats_lock:
+        for group in groups:
+            queue_depth[group] += 1
+            stats[f'{group}:queued'] += 1
+            stats[f'{group}:wait_seconds'] += delay
+
+    time.sleep(delay)
+
+    with stats_lock:
+        for group in groups:
+            queue_depth[group] -= 1
+
+
+def get_stats():
+    with stats_lock:
+        return {**stats, **{f'{group}:queue_depth': depth for group, depth in queue_depth.items()}}
@@ -0,0 +1,115 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+
+JOBS_KEY = 'scheduled_jobs'
+PROCESSING_KEY = 'scheduled_jobs:processing'
+PAYLOADS_KEY = 'scheduled_jobs:payloads'
+
+POLL_INTERVAL = 1
+BATCH_SIZE = 100
+VISIBILITY_TIMEOUT = 60
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 30
+
+logger = logging.getLogger('telegram_shop')
+
+# Move due jobs to the processing set in one step, so every job is claimed
+# by exactly one poller. Jobs whose claim expired (the poller died) are
+# made due again first.
+CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], job_id)
+    redis.call('ZADD', KEYS[1], ARGV[1], job_id)
+end
+
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+if #due == 0 then
+    return {{}, {}}
+end
+
+for _, job_id in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('ZADD', KEYS[2], ARGV[1] + ARGV[3], job_id)
+end
+return {due, redis.call('HMGET', KEYS[3], unpack(due))}
+"""
+
+
+def schedule(db, name, delay, **context):
+    job_id = uuid.uuid4().hex
+    job = {'name': name, 'context': context, 'attempts': 0}
+    with db.pipeline() as pipe:
+        pipe.hset(PAYLOADS_KEY, job_id, json.dumps(job))
+        pipe.zadd(JOBS_KEY, {job_id: time.time() + delay})
+        pipe.execute()
+    return job_id
+
+
+def cancel(db, job_id):
+    with db.pipeline() as pipe:
+        pipe.zrem(JOBS_KEY, job_id)
+        pipe.zrem(PROCESSING_KEY, job_id)
+        pipe.hdel(PAYLOADS_KEY, job_id)
+        pipe.execute()
+
+
+def complete(db, job_id):
+    with db.pipeline() as pipe:
+        pipe.zrem(PROCESSING_KEY, job_id)
+        pipe.hdel(PAYLOADS_KEY, job_id)
+        pipe.execute()
+
+
+def claim_due_jobs(db, limit=BATCH_SIZE):
+    job_ids, payloads = db.eval(
+        CLAIM_SCRIPT, 3, JOBS_KEY, PROCESSING_KEY, PAYLOADS_KEY, time.time(), limit, VISIBILITY_TIMEOUT)
+    return [(job_id, json.loads(payload)) for job_id, payload in zip(job_ids, payloads) if payload]
+
+
+def retry(db, job_id, job):
+    job['attempts'] += 1
+    with db.pipeline() as pipe:
+        pipe.zrem(PROCESSING_KEY, job_id)
+        if job['attempts'] < MAX_ATTEMPTS:
+            pipe.hset(PAYLOADS_KEY, job_id, json.dumps(job))
+            pipe.zadd(JOBS_KEY, {job_id: time.time() + RETRY_DELAY * job['attempts']})
+        else:
+            pipe.hdel(PAYLOADS_KEY, job_id)
+        pipe.execute()
+
+
+def run_pending(db, handlers, *args):
+    """Claim due jobs and run them, return how many were claimed."""
+    jobs = claim_due_jobs(db)
+    for job_id, job in jobs:
+        try:
+            handlers[job['name']](*args, job['context'])
+        except Exception as error:
+            logger.error(f'Scheduled job {job["name"]} failed (attempt {job["attempts"] + 1}): {error}')
+            retry(db, job_id, job)
+        else:
+            complete(db, job_id)
+
+    return len(jobs)
+
+
+def run_scheduler(db, handlers, *args, stop_event=None):
+    stop_event = stop_event or threading.Event()
+    while not stop_event.is_set():
+        try:
+            if run_pending(db, handlers, *args) == BATCH_SIZE:
+                continue
+        except Exception as error:
+            logger.error(f'Scheduler poll failed: {error}')
+        stop_event.wait(POLL_INTERVAL)
+
+
+def start_scheduler(db, handlers, *args):
+    thread = threading.Thread(target=run_scheduler, args=(db, handlers, *args), daemon=True)
+    thread.start()
+    return thread
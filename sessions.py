@@ -0,0 +1,83 @@
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+
+
+SESSION_TTL = 7 * 24 * 60 * 60
+DUPLICATE_WINDOW_MS = 1500
+
+stats = Counter()
+stats_lock = threading.Lock()
+
+
+def get_stats():
+    with stats_lock:
+        return dict(stats)
+
+
+def get_session_key(chat_id):
+    return f'session:{chat_id}'
+
+
+def is_duplicate_callback(db, chat_id, message_id, edit_date, text, data):
+    """True when the same button was pressed on the same rendering of a message within DUPLICATE_WINDOW_MS.
+
+    Messages are edited in place, so the edit date (unix time, 0 if never edited) and the
+    rendered text tell a repeated tap from a tap on the same button after a re-render.
+    Checked when the update arrives, so that the window does not shrink while it waits.
+    """
+    content_hash = hashlib.sha1((text or '').encode()).hexdigest()[:8]
+    key = f'{get_session_key(chat_id)}:callback:{message_id}:{edit_date or 0}:{content_hash}:{data}'
+    if db.set(key, 1, nx=True, px=DUPLICATE_WINDOW_MS):
+        return False
+
+    with stats_lock:
+        stats['updates:duplicate_callbacks'] += 1
+    return True
+
+
+def load_session(db, chat_id):
+    """Read the chat's session hash and push its idle TTL back, in one round trip.
+
+    Fields: state, menu_page, customer_id, latitude, longitude, pizzeria_id,
+    cart, cart_version, cart_synced_at. All values are strings.
+    """
+    key = get_session_key(chat_id)
+    with db.pipeline(transaction=False) as pipe:
+        session, _ = pipe.hgetall(key).expire(key, SESSION_TTL).execute()
+
+    return session
+
+
+def save_session(db, chat_id, session, loaded_session):
+    """Write only the fields that changed since `load_session`, in one round trip."""
+    changed = {field: str(value) for field, value in session.items() if loaded_session.get(field) != str(value)}
+    removed = [field for field in loaded_session if field not in session]
+    if not changed and not removed:
+        return
+
+    key = get_session_key(chat_id)
+    with db.pipeline(transaction=False) as pipe:
+        if changed:
+            pipe.hset(key, mapping=changed)
+        if removed:
+            pipe.hdel(key, *removed)
+        pipe.expire(key, SESSION_TTL)
+        pipe.execute()
+
+
+def get_cart_mirror(session, max_age):
+    """Return the mirrored (cart, cart_items), or None when missing or older than `max_age` seconds."""
+    if not session.get('cart') or time.time() - float(session.get('cart_synced_at', 0)) > max_age:
+        return None
+
+    mirror = json.loads(session['cart'])
+    return mirror['cart'], mirror['items']
+
+
+def set_cart_mirror(session, cart, cart_items):
+    session['cart'] = json.dumps({'cart': {'meta': cart['meta']}, 'items': cart_items})
+    session['cart_version'] = int(session.get('cart_version', 0)) + 1
+    session['cart_synced_at'] = time.time()
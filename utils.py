@@ -1,17 +1,71 @@
+import os
+import re
+
 import requests
 from geopy.distance import distance
 
+import breaker
+import cache
+import metrics
+
+
+GEOCODER_URL = os.getenv('YANDEX_GEOCODER_URL', 'https://geocode-maps.yandex.ru/1.x')
+GEOCODER_CACHE_TTL = 30 * 24 * 60 * 60
+GEOCODER_TIMEOUT = (3.05, 3)
+
+ADDRESS_ABBREVIATIONS = {
+    'г': 'город',
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'пл': 'площадь',
+    'наб': 'набережная',
+    'ш': 'шоссе',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+    'кв': 'квартира',
+}
+
+geocoder_breaker = breaker.get_breaker('yandex')
+
 
+@metrics.timed('yandex', 'geocode')
 def fetch_coordinates(apikey, place):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
     params = {"geocode": place, "apikey": apikey, "format": "json"}
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
+    with geocoder_breaker:
+        response = requests.get(GEOCODER_URL, params=params, timeout=GEOCODER_TIMEOUT)
+        response.raise_for_status()
     places_found = response.json()['response']['GeoObjectCollection']['featureMember']
     most_relevant = places_found[0]
     lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
     return lat, lon
 
 
+def normalize_address(address):
+    words = re.findall(r'\w+(?:-\w+)*', address.lower().replace('ё', 'е'))
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
+
+
+def fetch_coordinates_cached(db, apikey, place):
+    def fetch():
+        try:
+            return fetch_coordinates(apikey, place)
+        except IndexError:
+            return None
+
+    key = f'geocoder:{normalize_address(place)}'
+    coordinates = cache.get_or_set(db, key, fetch, GEOCODER_CACHE_TTL, local_ttl=GEOCODER_CACHE_TTL)
+    if coordinates is None:
+        raise IndexError(f'Address not found: {place}')
+
+    return coordinates
+
+
 def get_distance(coordinates_1, coordinates_2):
     return distance(coordinates_1, coordinates_2).km
@@ -0,0 +1,121 @@
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telegram
+
+import sessions
+
+
+QUEUE_KEY = 'telegram_updates'
+DEAD_LETTER_KEY = 'telegram_updates:dead'
+DEAD_LETTER_MAXLEN = 10000
+POLL_TIMEOUT = 5
+
+logger = logging.getLogger('telegram_shop')
+
+
+def get_chat_id(update_data):
+    message = (
+        update_data.get('message')
+        or update_data.get('edited_message')
+        or update_data.get('callback_query', {}).get('message')
+        or {}
+    )
+    return message.get('chat', {}).get('id')
+
+
+def is_duplicate_callback(db, update_data):
+    query = update_data.get('callback_query') or {}
+    message = query.get('message')
+    if not message:
+        return False
+
+    return sessions.is_duplicate_callback(
+        db, message['chat']['id'], message['message_id'], message.get('edit_date'),
+        message.get('text') or message.get('caption'), query.get('data'))
+
+
+def get_queue_key(chat_id, workers):
+    """All updates of one chat land in the same queue, so one worker handles them in order."""
+    return f'{QUEUE_KEY}:{(chat_id or 0) % workers}'
+
+
+def create_request_handler(db, workers, secret=None):
+    class WebhookRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if secret and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+                self.send_response(403)
+                self.end_headers()
+                return
+
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                update_data = json.loads(body)
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            if is_duplicate_callback(db, update_data):
+                # Answered in the webhook response, so the button stops spinning without a Bot API call
+                answer = json.dumps({
+                    'method': 'answerCallbackQuery',
+                    'callback_query_id': update_data['callback_query']['id'],
+                }).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(answer)))
+                self.end_headers()
+                self.wfile.write(answer)
+                return
+
+            db.rpush(get_queue_key(get_chat_id(update_data), workers), body)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return WebhookRequestHandler
+
+
+def run_webhook(db, host, port, workers, secret=None):
+    server = ThreadingHTTPServer((host, port), create_request_handler(db, workers, secret))
+    logger.info(f'Webhook listening on {host}:{port}, {workers} worker queues')
+    server.serve_forever()
+
+
+def requeue_processing(db, queue_key, processing_key):
+    """Put back updates a previous run of this worker took but did not finish, oldest first."""
+    requeued = 0
+    while db.lmove(processing_key, queue_key, 'RIGHT', 'LEFT'):
+        requeued += 1
+    if requeued:
+        logger.warning(f'Requeued {requeued} unfinished updates from {processing_key}')
+
+
+def run_worker(db, bot, worker, workers, handle_update):
+    queue_key = f'{QUEUE_KEY}:{worker}'
+    processing_key = f'{queue_key}:processing'
+    logger.info(f'Worker {worker} consuming {queue_key}')
+    requeue_processing(db, queue_key, processing_key)
+
+    while True:
+        # The update stays in the processing list until handled, so a worker that dies keeps it
+        body = db.blmove(queue_key, processing_key, POLL_TIMEOUT, 'LEFT', 'RIGHT')
+        if not body:
+            continue
+
+        try:
+            update = telegram.Update.de_json(json.loads(body), bot)
+            handle_update(bot, update)
+        except Exception as error:
+            logger.error(f'Update failed in worker {worker}, moved to {DEAD_LETTER_KEY}: {error}')
+            with db.pipeline(transaction=False) as pipe:
+                pipe.rpush(DEAD_LETTER_KEY, body)
+                pipe.ltrim(DEAD_LETTER_KEY, -DEAD_LETTER_MAXLEN, -1)
+                pipe.lrem(processing_key, 1, body)
+                pipe.execute()
+        else:
+            db.lrem(processing_key, 1, body)